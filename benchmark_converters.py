@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+# -*- encoding: utf-8 -*-
+'''
+Compare the date and text converters with the ones DumpTruck used to have.
+
+    python benchmark_converters.py [rows]
+'''
+
+import sys
+import datetime
+import sqlite3
+from timeit import default_timer
+from dumptruck import DumpTruck
+from dumptruck.adapters_and_converters import convert_date, convert_datetime
+
+# The converters as they were, for comparison
+def old_convert_date(val):
+  return datetime.date(*map(int, val.split('-')))
+
+def old_convert_datetime(val):
+  datepart, timepart = val.split(' ')
+  year, month, day = map(int, datepart.split('-'))
+  timepart_full = timepart.split('.')
+  hours, minutes, seconds = map(int, timepart_full[0].split(':'))
+  if len(timepart_full) == 2:
+    microseconds = int(timepart_full[1])
+  else:
+    microseconds = 0
+  return datetime.datetime(year, month, day, hours, minutes, seconds, microseconds)
+
+def old_text(val):
+  return val.decode('utf-8')
+
+def timed(function, *args):
+  start = default_timer()
+  function(*args)
+  return default_timer() - start
+
+def convert_all(converter, values):
+  for value in values:
+    converter(value)
+
+def select_all(dt):
+  for row in dt.iterexecute('SELECT * FROM events', row_factory = 'tuple'):
+    pass
+
+def main(rows):
+  # A few years of days, with many events on each of them
+  start = datetime.datetime(2012, 1, 1, 9, 30)
+  moments = [start + datetime.timedelta(days = i % 1000, seconds = i % 60) for i in range(rows)]
+  dates = [moment.date().isoformat() for moment in moments]
+  datetimes = [moment.isoformat(' ') for moment in moments]
+
+  # Values that never repeat, so that remembering them can't help
+  unique_dates = [(start + datetime.timedelta(days = i)).date().isoformat() for i in range(rows)]
+  unique_datetimes = [(start + datetime.timedelta(seconds = i, microseconds = i)).isoformat(' ') for i in range(rows)]
+
+  print 'Converting %d values (seconds)' % rows
+  print '%-16s %8s %8s' % ('', 'old', 'new')
+  for name, old, new, values in [
+    ('date', old_convert_date, convert_date, dates),
+    ('datetime', old_convert_datetime, convert_datetime, datetimes),
+    ('unique date', old_convert_date, convert_date, unique_dates),
+    ('unique datetime', old_convert_datetime, convert_datetime, unique_datetimes),
+  ]:
+    if hasattr(new, 'cache_clear'):
+      new.cache_clear()
+    print '%-16s %8.3f %8.3f' % (name, timed(convert_all, old, values), timed(convert_all, new, values))
+
+  dt = DumpTruck(':memory:')
+  dt.execute('CREATE TABLE events (day DATE, moment DATETIME, note TEXT)')
+  dt.insert([{'day': m.date(), 'moment': m, 'note': u'Ev\xe9nement %d' % (i % 100)} for i, m in enumerate(moments)], 'events')
+
+  convert_date.cache_clear()
+  new_time = timed(select_all, dt)
+
+  # Converters are looked up when the rows are fetched, so swapping them is enough.
+  sqlite3.register_converter('DATE', old_convert_date)
+  sqlite3.register_converter('DATETIME', old_convert_datetime)
+  sqlite3.register_converter('TEXT', old_text)
+  old_time = timed(select_all, dt)
+  del(sqlite3.converters['TEXT'])
+  sqlite3.register_converter('DATE', convert_date)
+  sqlite3.register_converter('DATETIME', convert_datetime)
+
+  print
+  print 'Selecting %d rows of DATE, DATETIME and TEXT (seconds)' % rows
+  print '%-16s %8.3f %8.3f' % ('select', old_time, new_time)
+
+if __name__ == '__main__':
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -23,6 +23,10 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 
 from dumptruck import *
+from pool import DumpTruckPool
+from writer import DumpTruckWriter
+from asynchronous import AsyncDumpTruck
+from shard import sharded_insert
 
 __title__ = 'dumptruck'
 __version__ = '0.1.6'
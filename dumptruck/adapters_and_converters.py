@@ -22,14 +22,113 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
 # OR OTHER DEALINGS IN THE SOFTWARE.
 
+import re
 import pickle
 import json
 import datetime
+import threading
+from contextlib import contextmanager
+from convert import memoize
+
+# How many distinct date strings to remember the conversions of
+DATE_CACHE_SIZE = 4096
+
+# The formats that the date and datetime adapters produce
+DATE = re.compile(r'(\d{4})-(\d\d)-(\d\d)$')
+DATETIME = re.compile(r'(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)(?:\.(\d+))?$')
 
 class Pickle:
     def __init__(self, obj):
         self.obj = obj
 
+# Whether the JSON and pickle converters are lazy in the current thread
+DECODING = threading.local()
+
+@contextmanager
+def lazy_decoding(lazy = True):
+    'Make the JSON and pickle converters return Lazy values inside a with block.'
+    previous = getattr(DECODING, 'lazy', False)
+    DECODING.lazy = lazy
+    try:
+        yield
+    finally:
+        DECODING.lazy = previous
+
+# What a Lazy value is before it is decoded
+UNDECODED = object()
+
+class Lazy(object):
+    '''
+    A value from a JSON or pickle column that isn't decoded until it is
+    first used. It behaves like the decoded value, which is also its
+    value attribute. Saving it again stores the original text if it was
+    never decoded.
+    '''
+    __slots__ = ('raw', 'column_type', '_decode', '_encode', '_value')
+
+    def __init__(self, raw, column_type, decode, encode):
+        self.raw = raw
+        self.column_type = column_type
+        self._decode = decode
+        self._encode = encode
+        self._value = UNDECODED
+
+    @property
+    def value(self):
+        if self._value is UNDECODED:
+            self._value = self._decode(self.raw)
+        return self._value
+
+    def encode(self):
+        'The text to store for the value.'
+        return self.raw if self._value is UNDECODED else self._encode(self._value)
+
+    def __deepcopy__(self, memo):
+        # A copy is decoded afresh, so it doesn't share the decoded value.
+        return Lazy(self.encode(), self.column_type, self._decode, self._encode)
+
+    def __getattr__(self, name):
+        return getattr(self.value, name)
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __unicode__(self):
+        return unicode(self.value)
+
+    def __nonzero__(self):
+        return bool(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __setitem__(self, key, item):
+        self.value[key] = item
+
+    def __delitem__(self, key):
+        del(self.value[key])
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __hash__(self):
+        return hash(self.value)
+
 def register_big(module):
     def adapt_long(val):
         'Handle very large integers.'
@@ -41,16 +140,17 @@ def register_unicode(module):
     def text(val):
         return val.decode('utf-8')
 
+    # sqlite3 already returns text as unicode, so there is no text converter.
     module.register_adapter(unicode, text)
     module.register_adapter(str, text)
-    module.register_converter('TEXT', text)
-    module.register_converter('text', text)
 
 def register_pickle(module):
     def adapt_pickle(val):
         return pickle.dumps(val.obj)
 
     def convert_pickle(val):
+        if getattr(DECODING, 'lazy', False):
+            return Lazy(val, u'pickle text', pickle.loads, pickle.dumps)
         return pickle.loads(val)
 
     module.register_adapter(Pickle, adapt_pickle)
@@ -66,20 +166,65 @@ def register_json(module):
         return json.dumps(d, ensure_ascii=True)
 
     def convert_json(val):
+        if getattr(DECODING, 'lazy', False):
+            return Lazy(val, u'json text', json.loads, adapt_json)
         return json.loads(val)
 
     def convert_jsonset(val):
+        if getattr(DECODING, 'lazy', False):
+            return Lazy(val, u'jsonset text', lambda val: set(json.loads(val).keys()), adapt_jsonset)
         return set(json.loads(val).keys())
 
+    def adapt_lazy(val):
+        return val.encode()
+
     module.register_adapter(list, adapt_json)
     module.register_adapter(tuple, adapt_json)
     module.register_adapter(dict, adapt_json)
     module.register_adapter(set, adapt_jsonset)
+    module.register_adapter(Lazy, adapt_lazy)
     module.register_converter('json', convert_json)
     module.register_converter('JSON', convert_json)
     module.register_converter('jsonset', convert_jsonset)
     module.register_converter('JSONSET', convert_jsonset)
 
+@memoize(DATE_CACHE_SIZE)
+def convert_date(val):
+    'Parse a date, remembering recent ones because columns repeat them a lot.'
+    match = DATE.match(val)
+    if match == None:
+        return datetime.date(*map(int, val.split('-')))
+
+    year, month, day = match.groups()
+    return datetime.date(int(year), int(month), int(day))
+
+def convert_datetime(val):
+    '''
+    Parse a datetime. Unlike dates, datetimes seldom repeat, and then
+    remembering them costs more than it saves.
+    '''
+    match = DATETIME.match(val)
+    if match == None:
+        return parse_datetime(val)
+
+    year, month, day, hours, minutes, seconds, microseconds = match.groups()
+    return datetime.datetime(int(year), int(month), int(day),
+        int(hours), int(minutes), int(seconds), int(microseconds or 0))
+
+def parse_datetime(val):
+    'Parse a datetime that is formatted less strictly than the adapter formats it.'
+    datepart, timepart = val.split(' ')
+    year, month, day = map(int, datepart.split('-'))
+    timepart_full = timepart.split('.')
+    hours, minutes, seconds = map(int, timepart_full[0].split(':'))
+    if len(timepart_full) == 2:
+        microseconds = int(timepart_full[1])
+    else:
+        microseconds = 0
+
+    val = datetime.datetime(year, month, day, hours, minutes, seconds, microseconds)
+    return val
+
 def register_dates(module):
     def adapt_date(val):
         return val.isoformat()
@@ -87,22 +232,6 @@ def register_dates(module):
     def adapt_datetime(val):
         return val.isoformat(' ')
 
-    def convert_date(val):
-        return datetime.date(*map(int, val.split('-')))
-
-    def convert_datetime(val):
-        datepart, timepart = val.split(' ')
-        year, month, day = map(int, datepart.split('-'))
-        timepart_full = timepart.split('.')
-        hours, minutes, seconds = map(int, timepart_full[0].split(':'))
-        if len(timepart_full) == 2:
-            microseconds = int(timepart_full[1])
-        else:
-            microseconds = 0
-
-        val = datetime.datetime(year, month, day, hours, minutes, seconds, microseconds)
-        return val
-
     module.register_adapter(datetime.date, adapt_date)
     module.register_adapter(datetime.datetime, adapt_datetime)
     module.register_converter('DATE', convert_date)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python2
+'Use a DumpTruck without blocking, through futures'
+
+# This file is part of DumpTruck.
+
+# Copyright (C) 2012 ScraperWiki Ltd. and other contributors
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import threading
+import Queue
+from dumptruck import DumpTruck
+from writer import Future
+
+# Tells the DumpTruck's thread to finish
+STOP = object()
+
+class AsyncDumpTruck:
+  '''
+  Run a DumpTruck on a thread of its own, so that callers such as
+  event loops never wait for the disk. Calling a DumpTruck method
+  (insert, execute, save_var, &c.) on an AsyncDumpTruck queues it
+  and returns a Future; the methods run one at a time, in order.
+  Keyword arguments to the constructor go to the DumpTruck.
+  '''
+
+  def __init__(self, dbname = 'dumptruck.db', **kwargs):
+    self.__queue = Queue.Queue()
+    self.__closed = False
+    self.__lock = threading.Lock()
+
+    # The DumpTruck must be made in the thread that uses it.
+    started = Future()
+    self.__thread = threading.Thread(target = self.__run, args = (dbname, kwargs, started))
+    self.__thread.daemon = True
+    self.__thread.start()
+    started.result()
+
+  def __run(self, dbname, kwargs, started):
+    try:
+      self.__dt = DumpTruck(dbname, **kwargs)
+    except Exception, e:
+      started.set_exception(e)
+      return
+    else:
+      started.set_result(None)
+
+    while True:
+      job = self.__queue.get()
+      if job is STOP:
+        break
+      future, function, args, kwargs = job
+      try:
+        result = function(*args, **kwargs)
+      except Exception, e:
+        future.set_exception(e)
+      else:
+        future.set_result(result)
+
+    self.__dt.close()
+
+  def submit(self, function, *args, **kwargs):
+    '''
+    Queue function(dt, *args, **kwargs), where dt is the DumpTruck,
+    and return a Future of its result.
+    '''
+    return self.__submit(function, self.__dt, *args, **kwargs)
+
+  def __submit(self, function, *args, **kwargs):
+    future = Future()
+    with self.__lock:
+      if self.__closed:
+        raise ValueError('The AsyncDumpTruck is closed.')
+      self.__queue.put((future, function, args, kwargs))
+    return future
+
+  def iterexecute(self, sql, *args, **kwargs):
+    '''
+    Run a query and return a Future of a ResultStream,
+    which fetches the rows a chunk at a time.
+    '''
+    chunk_size = kwargs.get('chunk_size', 1000)
+    def start(dt):
+      rows = dt.iterexecute(sql, *args, **kwargs)
+      return None if rows == None else ResultStream(self, rows, chunk_size)
+    return self.submit(start)
+
+  def iterdump(self, table_name = 'dumptruck', **kwargs):
+    chunk_size = kwargs.get('chunk_size', 1000)
+    def start(dt):
+      return ResultStream(self, dt.iterdump(table_name, **kwargs), chunk_size)
+    return self.submit(start)
+
+  def close(self):
+    'Finish everything that is queued, then close the database.'
+    with self.__lock:
+      if self.__closed:
+        return
+      self.__closed = True
+      self.__queue.put(STOP)
+    self.__thread.join()
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    method = getattr(DumpTruck, name)
+    def submit(*args, **kwargs):
+      return self.__submit(method, self.__dt, *args, **kwargs)
+    submit.__name__ = name
+    submit.__doc__ = method.__doc__
+    return submit
+
+class ResultStream:
+  '''
+  The rows of a query running on an AsyncDumpTruck. Each call to
+  next_chunk returns a Future of the next list of rows, which is
+  empty once there are no more.
+  '''
+
+  def __init__(self, adt, rows, chunk_size):
+    self.__adt = adt
+    self.__rows = rows
+    self.chunk_size = chunk_size
+
+  def next_chunk(self):
+    def fetch(dt):
+      chunk = []
+      for row in self.__rows:
+        chunk.append(row)
+        if len(chunk) == self.chunk_size:
+          break
+      return chunk
+    return self.__adt.submit(fetch)
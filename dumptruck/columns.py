@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+'Query results by column, in typed arrays'
+
+# This file is part of DumpTruck.
+
+# Copyright (C) 2012 ScraperWiki Ltd. and other contributors
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+import array
+from collections import OrderedDict
+from itertools import izip
+
+try:
+  import numpy
+except ImportError:
+  # NumPy is optional; without it, columns are array.arrays and lists.
+  numpy = None
+
+# array.array typecodes for the kinds of column that fit in one
+TYPECODES = {u'integer': 'l', u'real': 'd', u'boolean': 'b'}
+
+# NumPy types for the kinds of column that don't
+NUMPY_TYPES = {u'date': 'datetime64[D]', u'datetime': 'datetime64[us]'}
+
+def column_kind(column_type):
+  '''
+  Whether a declared column type holds integers, reals, booleans, dates
+  or datetimes, following SQLite's rules for type affinity, or None.
+  '''
+  words = (column_type or u'').lower().split()
+  name = words[0] if len(words) > 0 else u''
+  if name in (u'boolean', u'date', u'datetime'):
+    return name
+  elif u'int' in name:
+    return u'integer'
+  elif any(part in name for part in (u'real', u'floa', u'doub')):
+    return u'real'
+  else:
+    return None
+
+# How many values to turn from NumPy into Python objects at a time
+NUMPY_CHUNK_SIZE = 1000
+
+def column_values(column, mask = None):
+  '''
+  The values of a column as Python objects, with None for NULLs, which
+  are the masked values if the column is a NumPy masked array and
+  otherwise the ones that mask marks.
+  '''
+  if numpy != None and isinstance(column, numpy.ndarray):
+    return (value
+      for start in xrange(0, len(column), NUMPY_CHUNK_SIZE)
+      for value in column[start:start + NUMPY_CHUNK_SIZE].tolist())
+  elif mask != None:
+    return (None if null else value for value, null in izip(column, mask))
+  else:
+    return column
+
+class Columns(OrderedDict):
+  '''
+  Columns of query results by name. The masks attribute holds, by
+  name, which of each column's values were NULL.
+  '''
+
+class ColumnBuilder:
+  'Collect the values of one column, in an array if its kind allows.'
+
+  def __init__(self, kind):
+    self.kind = kind
+    self.nulls = array.array('B')
+    if kind in TYPECODES:
+      self.values = array.array(TYPECODES[kind])
+    else:
+      self.values = []
+
+  def extend(self, values):
+    if type(self.values) == array.array:
+      try:
+        self.values.extend(array.array(self.values.typecode, [0 if value is None else value for value in values]))
+      except (TypeError, OverflowError):
+        # SQLite let something else into the column, so keep Python objects.
+        self.values = [None if null else value for value, null in zip(self.values, self.nulls)]
+    if type(self.values) == list:
+      self.values.extend(values)
+    self.nulls.extend([value is None for value in values])
+
+  def finish(self, use_numpy):
+    'The column and the mask of its NULLs, as arrays or as NumPy arrays.'
+    if not use_numpy:
+      return self.values, self.nulls
+
+    mask = from_array(self.nulls).astype(bool)
+    if type(self.values) == array.array:
+      data = from_array(self.values)
+      if self.kind == u'boolean':
+        data = data.astype(bool)
+    else:
+      try:
+        data = numpy.array(self.values, dtype = NUMPY_TYPES[self.kind])
+      except (KeyError, ValueError, TypeError):
+        # Fill an object array one by one so that sequences stay whole.
+        data = numpy.empty(len(self.values), dtype = object)
+        for i, value in enumerate(self.values):
+          data[i] = value
+    return numpy.ma.MaskedArray(data, mask = mask), mask
+
+def from_array(values):
+  'A NumPy array that shares the memory of an array.array.'
+  if len(values) == 0:
+    return numpy.array([], dtype = values.typecode)
+  return numpy.frombuffer(values, dtype = values.typecode)
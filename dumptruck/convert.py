@@ -25,13 +25,58 @@
 from copy import copy
 import re
 import datetime
-from collections import OrderedDict
+import threading
+from collections import OrderedDict, deque, namedtuple
+from functools import wraps
 
 QUOTEPAIRS = [
   (u'`', u'`'),
   (u'[', u']'),
 ]
 
+# How many identifiers quote and simplify remember
+IDENTIFIER_CACHE_SIZE = 1024
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+def memoize(maxsize):
+  '''
+  Remember the results of a function of one string, forgetting them all
+  once there are maxsize of them, like the re module does. Like Python 3's
+  lru_cache, the function gets cache_info and cache_clear methods. It is
+  safe to call from several threads, since each step is one dict
+  operation, though the counts of hits and misses may be a little off.
+  '''
+  def decorator(func):
+    cache = {}
+    stats = {'hits': 0, 'misses': 0}
+
+    @wraps(func)
+    def wrapper(text):
+      try:
+        result = cache[text]
+      except KeyError:
+        stats['misses'] += 1
+        result = func(text)
+        if len(cache) >= maxsize:
+          cache.clear()
+        cache[text] = result
+      else:
+        stats['hits'] += 1
+      return result
+
+    def cache_info():
+      return CacheInfo(stats['hits'], stats['misses'], maxsize, len(cache))
+
+    def cache_clear():
+      cache.clear()
+      stats['hits'] = stats['misses'] = 0
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    return wrapper
+  return decorator
+
 def convert(data):
 
   try:
@@ -40,7 +85,7 @@ def convert(data):
     # http://stackoverflow.com/questions/1952464/
     # in-python-how-do-i-determine-if-a-variable-is-iterable
     try:
-      [e for e in data]
+      iter(data)
     except TypeError:
       raise TypeError(
         'The data argument must be a mapping (like a dict), '
@@ -50,25 +95,34 @@ def convert(data):
     # It is a single dictionary
     data = [data]
 
+  # Quoted column names, by the column names of a row
+  quoted_keys = {}
+
   data_quoted = []
   for row in data:
+    checkvalues(row)
 
-    checkdata(row)
-
-    # Delete nones
-    for key, value in row.items():
-      if value == None:
-        del(row[key])
-
-    if len(set([k.lower() for k in row.keys()])) != len(row.keys()):
-      raise ValueError(u'You passed the same column name twice. (Column names are insensitive to case.)')
+    # Skip nones
+    pairs = [(key, value) for key, value in row.items() if value is not None]
+    keys = tuple(pair[0] for pair in pairs)
 
-    data_quoted.append(zip([quote(k) for k in row.keys()], row.values()))
+    # Rows tend to share their keys, so only check and quote new sets of them.
+    try:
+      quoted = quoted_keys[keys]
+    except KeyError:
+      checkkeys(keys)
+      if len(set([k.lower() for k in keys])) != len(keys):
+        raise ValueError(u'You passed the same column name twice. (Column names are insensitive to case.)')
+      quoted = quoted_keys[keys] = [quote(k) for k in keys]
+
+    data_quoted.append(zip(quoted, [pair[1] for pair in pairs]))
   return data_quoted
 
+@memoize(IDENTIFIER_CACHE_SIZE)
 def simplify(text):
   return re.sub(r'[^a-zA-Z0-9]', '', text)
 
+@memoize(IDENTIFIER_CACHE_SIZE)
 def quote(text):
   'Handle quote characters'
 
@@ -90,11 +144,18 @@ def quote(text):
   raise ValueError(u'The value "%s" is not quoted and contains too many quote characters to quote' % text)
 
 def checkdata(data):
-  for key, value in data.items():
+  checkkeys(data.keys())
+  checkvalues(data)
+
+def checkkeys(keys):
+  for key in keys:
     # Column names
     if key in [None, '']:
       raise ValueError('key must not be blank')
     elif not isinstance(key, (unicode, str)):
       raise ValueError(u'The column name must be of unicode or str type. The column name ("%s") is of type %s. If this error doesn\'t make sense, try "unicode(\'%s\')".' % (key, type(key), key))
-    elif isinstance(value, dict) and not all(isinstance(k, (unicode, str)) for k in value.keys()):
+
+def checkvalues(data):
+  for value in data.values():
+    if isinstance(value, dict) and not all(isinstance(k, (unicode, str)) for k in value.keys()):
       raise ValueError('Dictionary keys must all be str or unicode for database insert.')
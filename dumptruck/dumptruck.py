@@ -24,10 +24,21 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 
 import re
+import csv
+import json
 import datetime
+import hashlib
+from timeit import default_timer
+from contextlib import contextmanager
 from collections import OrderedDict
-from convert import convert, quote, simplify
-from adapters_and_converters import register_adapters_and_converters, Pickle, replace_date_converter
+from itertools import chain, groupby, islice, izip
+from operator import itemgetter
+from convert import convert, quote, simplify, memoize, checkkeys
+from adapters_and_converters import register_adapters_and_converters, Pickle, Lazy, lazy_decoding, replace_date_converter
+from rows import Record, record_type
+from results import ResultCache
+from columns import Columns, ColumnBuilder, column_kind, column_values, numpy
+from loaders import infer_parsers, summarize
 
 PYTHON_SQLITE_TYPE_MAP={
   unicode: u'text',
@@ -59,9 +70,110 @@ except ImportError:
     pass
 
 
+# Named sets of PRAGMAs for DumpTruck(profile = ...)
+PRAGMA_PROFILES = {
+  # SQLite's durable defaults
+  u'safe': OrderedDict([
+    (u'journal_mode', u'DELETE'),
+    (u'synchronous', u'FULL'),
+  ]),
+
+  # Fast, big writes that can be redone if the machine crashes
+  u'bulk_load': OrderedDict([
+    (u'journal_mode', u'WAL'),
+    (u'synchronous', u'OFF'),
+    (u'cache_size', -262144),
+    (u'temp_store', u'MEMORY'),
+  ]),
+
+  # Lots of readers, few writers
+  u'read_mostly': OrderedDict([
+    (u'journal_mode', u'WAL'),
+    (u'synchronous', u'NORMAL'),
+    (u'cache_size', -65536),
+    (u'mmap_size', 268435456),
+    (u'temp_store', u'MEMORY'),
+  ]),
+}
+
+# PRAGMAs that must be set before the others
+PRAGMA_ORDER = {u'page_size': 0, u'journal_mode': 1}
+
+# PRAGMAs that DumpTruck.pragmas always reports
+PRAGMA_REPORTED = (u'journal_mode', u'synchronous', u'cache_size', u'mmap_size', u'temp_store', u'page_size')
+
+PRAGMA_NAME = re.compile(r'^[A-Za-z_]+$')
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+# How many variables get_vars asks for in one query
+VARS_CHUNK_SIZE = 500
+
+# Column where detect_changes = 'hash' keeps a digest of each row
+HASH_COLUMN = u'_dumptruck_hash'
+
+# How many INSERT statements each DumpTruck remembers the SQL of
+INSERT_SQL_CACHE_SIZE = 256
+
+# SQLite's smallest limit on the number of parameters in one statement
+MAX_PARAMETERS = 999
+
+# Ways of representing a result row
+ROW_FACTORIES = (u'ordereddict', u'tuple', u'row', u'record')
+
+# Statements that can change the schema
+DDL = re.compile(r'\s*(CREATE|ALTER|DROP)\b', re.IGNORECASE)
+
+# Statements that don't change what is in the tables
+READ_ONLY = re.compile(r'\s*(SELECT|PRAGMA|EXPLAIN)\b', re.IGNORECASE)
+
+# Statements whose results can be cached
+CACHEABLE = re.compile(r'\s*SELECT\b', re.IGNORECASE)
+
+# Opcodes that open a table or index, whose root page is their second operand
+OPEN_OPCODES = (u'OpenRead', u'ReopenIdx', u'OpenWrite')
+
+# Opcodes that call a function, whose name and argument count are their fourth operand
+FUNCTION_OPCODES = (u'Function', u'Function0', u'PureFunc', u'PureFunc0')
+
+# Functions that SQLite calls deterministic, though they can read the clock
+TIME_FUNCTIONS = frozenset([u'date', u'time', u'datetime', u'julianday', u'strftime',
+  u'unixepoch', u'current_date', u'current_time', u'current_timestamp'])
+
+# SQLITE_DETERMINISTIC, in pragma_function_list's flags
+DETERMINISTIC = 0x800
+
 def get_column_type(obj):
   'Decide the type of a column to contain an object.'
-  return u'pickle text' if isinstance(obj, Pickle) else PYTHON_SQLITE_TYPE_MAP[type(obj)]
+  if isinstance(obj, Pickle):
+    return u'pickle text'
+  elif isinstance(obj, Lazy):
+    return obj.column_type
+  else:
+    return PYTHON_SQLITE_TYPE_MAP[type(obj)]
+
+def guess_column_type(rows, i):
+  'Decide the type of a column from the first value in it that isn\'t NULL.'
+  for row in rows:
+    if row[i] is not None:
+      try:
+        return get_column_type(row[i])
+      except KeyError:
+        return None
+  return None
+
+# Numeric types, narrowest first
+NUMERIC_COLUMN_TYPES = (u'boolean', u'integer', u'real')
+
+def common_column_type(column_types):
+  '''
+  Decide the type of a column to contain objects of several types,
+  given their column types in order of appearance.
+  '''
+  if set(column_types).issubset(NUMERIC_COLUMN_TYPES):
+    # The widest numeric type holds all the numbers.
+    return max(column_types, key = NUMERIC_COLUMN_TYPES.index)
+  else:
+    return column_types[0]
 
 # Only for compatibility with scraperwiki;
 # we should use the SQLite names
@@ -73,7 +185,7 @@ class DumpTruck:
   'A relaxing interface to SQLite'
 
 
-  def __init__(self, dbname = 'dumptruck.db', vars_table = '_dumptruckvars', vars_table_tmp = '_dumptruckvarstmp', auto_commit = True, adapt_and_convert = True, timeout = 5):
+  def __init__(self, dbname = 'dumptruck.db', vars_table = '_dumptruckvars', vars_table_tmp = '_dumptruckvarstmp', auto_commit = True, adapt_and_convert = True, timeout = 5, row_factory = u'ordereddict', profile = None, pragmas = None, schema_cache = None, lazy = False, cached_statements = 100, result_cache_rows = None, result_cache_bytes = None):
 
     self.sqlite3 = __import__('sqlite3')
 
@@ -92,7 +204,7 @@ class DumpTruck:
     if type(dbname) not in [unicode, str]:
       raise TypeError('dbname must be a string')
     else:
-      self.connection=self.sqlite3.connect(dbname, detect_types = self.sqlite3.PARSE_DECLTYPES, timeout=timeout)
+      self.connection=self.sqlite3.connect(dbname, detect_types = self.sqlite3.PARSE_DECLTYPES, timeout=timeout, cached_statements=cached_statements)
       self.cursor=self.connection.cursor()
 
     # Make sure it's a good table name
@@ -107,49 +219,417 @@ class DumpTruck:
     else:
       self.__vars_table_tmp = vars_table_tmp
 
+    # How should result rows be represented?
+    if row_factory not in ROW_FACTORIES:
+      raise ValueError(u'row_factory must be one of %s.' % u', '.join(ROW_FACTORIES))
+    else:
+      self.row_factory = row_factory
+
+    # Should JSON and pickle values be decoded only when they are used?
+    if type(lazy) != bool:
+      raise TypeError('lazy must be True or False.')
+    else:
+      self.lazy = lazy
+
+    # PRAGMA table_info results, by table, until the schema changes;
+    # DumpTrucks on the same file may share them.
+    self.__table_infos = {} if schema_cache == None else schema_cache
+
+    # The schema_version of the database when we last looked at it
+    self.__schema_version = None
+
+    # Stored values and types of variables that have been read
+    self.__vars = {}
+
+    # Whether the variables table is known to be there
+    self.__vars_table_checked = False
+
+    # How many transaction blocks we are inside
+    self.__transaction_depth = 0
+
+    # Results of SELECT queries, if they are cached, and the data_version
+    # of the database when they and the variables were read
+    if result_cache_rows == None and result_cache_bytes == None:
+      self.__results = None
+    else:
+      self.__results = ResultCache(result_cache_rows, result_cache_bytes)
+    self.__data_version = None
+
+    # Names of the functions whose results only depend on their arguments
+    self.__deterministic = None
+
+    # SQL of INSERT statements, by table, mode and columns
+    self.__insert_sql = memoize(INSERT_SQL_CACHE_SIZE)(self.__build_insert_sql)
+
+    # Performance settings
+    if profile != None and profile not in PRAGMA_PROFILES:
+      raise ValueError(u'profile must be one of %s.' % u', '.join(sorted(PRAGMA_PROFILES)))
+    elif pragmas != None and not hasattr(pragmas, 'items'):
+      raise TypeError('pragmas must be a mapping')
+    else:
+      self.__pragmas = OrderedDict(PRAGMA_PROFILES.get(profile, []))
+      self.__pragmas.update(pragmas or {})
+      self.__apply_pragmas()
+
+  def __apply_pragmas(self):
+    # page_size only counts before anything is written, and
+    # it can't change once the journal is a write-ahead log.
+    names = sorted(self.__pragmas, key = lambda name: PRAGMA_ORDER.get(name.lower(), len(PRAGMA_ORDER)))
+    for name in names:
+      value = self.__pragmas[name]
+      if not PRAGMA_NAME.match(name) or not PRAGMA_VALUE.match(unicode(value)):
+        raise ValueError(u'"%s = %s" doesn\'t look like a PRAGMA setting.' % (name, value))
+      self.cursor.execute(u'PRAGMA %s = %s' % (name, value))
+      self.cursor.fetchall()
+
+  def pragmas(self):
+    '''
+    The current values of the performance settings, and of any other
+    PRAGMAs passed when the DumpTruck was made, as read from SQLite.
+    A PRAGMA statement would commit pending work, so they are selected
+    from SQLite's pragma functions instead; the few settings without
+    one, like mmap_size, are the values passed, or None.
+    '''
+    names = list(PRAGMA_REPORTED) + [name for name in self.__pragmas if name.lower() not in PRAGMA_REPORTED]
+    settings = OrderedDict()
+    for name in names:
+      try:
+        self.cursor.execute(u'SELECT * FROM pragma_%s' % name)
+      except self.sqlite3.OperationalError:
+        settings[name] = self.__pragmas.get(name)
+        continue
+      row = self.cursor.fetchone()
+      settings[name] = None if row == None else row[0]
+    return settings
+
   def column_names(self, table):
       """An iterable of column names, for a particular table or
       view."""
 
       table_info = self.execute(
-        u'PRAGMA table_info(%s)' % quote(table))
-      return (column['name'] for column in table_info)
+        u'PRAGMA table_info(%s)' % quote(table), row_factory = u'tuple')
+      return (column[1] for column in table_info)
+
+  def __forget_schema(self):
+    'Forget what we know about the database after its schema changes.'
+    self.__table_infos.clear()
+    self.__vars.clear()
+    self.__vars_table_checked = False
+    if self.__results != None:
+      self.__results.clear()
+
+  def __check_schema_version(self):
+    'Forget what we know about the schema if anything, even another connection, changed it.'
+    try:
+      self.cursor.execute(u'SELECT schema_version FROM pragma_schema_version')
+      schema_version = self.cursor.fetchone()[0]
+    except self.sqlite3.OperationalError:
+      # SQLite before 3.16 can't tell us, so assume it changed.
+      schema_version = None
+    if schema_version == None or schema_version != self.__schema_version:
+      self.__forget_schema()
+      self.__schema_version = schema_version
 
   def __check_or_create_vars_table(self):
+    self.__check_schema_version()
+    if self.__vars_table_checked:
+      return
+
     sql = u"CREATE TABLE IF NOT EXISTS %s (`key` text PRIMARY KEY, `value` blob, `type` text)" % quote(self.__vars_table)
     self.execute(sql, commit = False)
 
     self.commit()
 
-    table_info = self.execute(u'PRAGMA table_info(%s)' % quote(self.__vars_table))
-    column_names_observed = set([column['name'] for column in table_info])
+    table_info = self.execute(u'PRAGMA table_info(%s)' % quote(self.__vars_table), row_factory = u'tuple')
+    column_names_observed = set([column[1] for column in table_info])
     column_names_expected = {'key', 'type', 'value'}
     assert column_names_observed == column_names_expected, table_info
+    self.__vars_table_checked = True
 
   def execute(self, sql, *args, **kwargs):
     '''
     Run raw SQL on the database, and receive relaxing output.
     This is sort of the foundational method that most of the
-    others build on.
+    others build on. Pass row_factory or lazy to override the
+    ones chosen when the DumpTruck was made.
     '''
-    try:
-      self.cursor.execute(sql, *args)
-    except self.sqlite3.InterfaceError, msg:
-      raise self.sqlite3.InterfaceError(unicode(msg) + '\nTry converting types or pickling.')
-    rows = self.cursor.fetchall()
+    row_factory = kwargs.get('row_factory', self.row_factory)
+    lazy = kwargs.get('lazy', self.lazy)
+
+    key = self.__result_key(sql, args, row_factory, lazy)
+    if key != None:
+      cached = self.__results.get(key)
+      if cached != None:
+        self.__commit_if_necessary(kwargs)
+        colnames, rows = cached
+        make_row = self.__row_maker(None, row_factory, colnames)
+        return rows if make_row == None else map(make_row, rows)
+
+    # sqlite3 converts the first row as soon as it executes the query.
+    with lazy_decoding(lazy):
+      try:
+        self.cursor.execute(sql, *args)
+      except self.sqlite3.InterfaceError, msg:
+        raise self.sqlite3.InterfaceError(unicode(msg) + '\nTry converting types or pickling.')
+      rows = self.cursor.fetchall()
+
+    self.__after_statement(sql)
+
+    # Working out what the query read would commit anything pending, so
+    # only do it if we are about to commit or are inside a transaction block.
+    colnames = None if self.cursor.description == None else self.__colnames(self.cursor)
+    if key != None and (kwargs.get('commit', self.auto_commit) or self.__transaction_depth > 0):
+      # Queries that read no tables, like SELECT last_insert_rowid(), can't be
+      # invalidated, so they aren't cached.
+      tables = self.__tables_read(sql, args)
+      if tables:
+        self.__results.put(key, tables, colnames, rows)
 
     self.__commit_if_necessary(kwargs)
 
-    if None == self.cursor.description:
+    if colnames == None:
+      return None
+    else:
+      make_row = self.__row_maker(self.cursor, row_factory, colnames)
+      return rows if make_row == None else map(make_row, rows)
+
+  def __after_statement(self, sql):
+    'Forget what a raw SQL statement might have changed.'
+    if DDL.match(sql):
+      self.__forget_schema()
+    elif not READ_ONLY.match(sql):
+      # We can't tell which tables it wrote to.
+      self.__vars.clear()
+      if self.__results != None:
+        self.__results.clear()
+
+  def result_cache_info(self):
+    'Hits, misses, and how many results, rows and bytes the result cache holds.'
+    return None if self.__results == None else self.__results.info()
+
+  def __result_key(self, sql, args, row_factory, lazy):
+    "The result cache's key for a query, or None if it can't be cached."
+    if self.__results == None or row_factory == u'row' or not CACHEABLE.match(sql):
+      return None
+
+    self.__check_data_version()
+    params = args[0] if len(args) > 0 else ()
+    params = tuple(sorted(params.items())) if hasattr(params, 'items') else tuple(params)
+    key = (sql, params, lazy)
+    try:
+      hash(key)
+    except TypeError:
+      return None
+    return key
+
+  def __check_data_version(self):
+    'Forget cached results and variables if another connection has changed the database.'
+    try:
+      self.cursor.execute(u'SELECT data_version FROM pragma_data_version')
+      data_version = self.cursor.fetchone()[0]
+    except self.sqlite3.OperationalError:
+      # SQLite before 3.16 can't tell us, so assume it changed.
+      data_version = None
+    if data_version == None or data_version != self.__data_version:
+      self.__vars.clear()
+      if self.__results != None:
+        self.__results.clear()
+      self.__data_version = data_version
+
+  def __tables_read(self, sql, args):
+    '''
+    Lowercase names of the tables that a query reads, or None if we can't
+    tell or if it calls a function that can give a different answer each time.
+    '''
+    cursor = self.connection.cursor()
+    cursor.execute(u'EXPLAIN ' + sql, *args)
+    root_pages = set()
+    for row in cursor.fetchall():
+      opcode, root_page, database = row[1], row[3], row[4]
+      if opcode == u'VOpen' or (opcode in OPEN_OPCODES and database != 0):
+        # Virtual, temporary or attached tables
+        return None
+      elif opcode in FUNCTION_OPCODES and row[5].split(u'(')[0].lower() not in self.__deterministic_functions(cursor):
+        return None
+      elif opcode in OPEN_OPCODES:
+        root_pages.add(root_page)
+
+    cursor.execute(u'SELECT rootpage, tbl_name FROM sqlite_master')
+    tables = dict(cursor.fetchall())
+    tables[1] = u'sqlite_master'
+    return set(tables[page].lower() for page in root_pages if page in tables)
+
+  def __deterministic_functions(self, cursor):
+    'Lowercase names of the functions whose results only depend on their arguments.'
+    if self.__deterministic == None:
+      try:
+        cursor.execute(u'SELECT name FROM pragma_function_list WHERE flags & ?', [DETERMINISTIC])
+        names = set(row[0].lower() for row in cursor.fetchall())
+      except self.sqlite3.OperationalError:
+        # SQLite before 3.30 can't tell us, so treat every function as unpredictable.
+        names = set()
+      self.__deterministic = frozenset(names - TIME_FUNCTIONS)
+    return self.__deterministic
+
+  def __forget_results(self, table_name):
+    'Forget cached results that read a table, before we write to it.'
+    if quote(table_name)[1:-1].lower() == quote(self.__vars_table)[1:-1].lower():
+      self.__vars.clear()
+    if self.__results != None:
+      self.__results.invalidate(quote(table_name)[1:-1].lower())
+
+  def iterexecute(self, sql, *args, **kwargs):
+    '''
+    Run raw SQL like execute, but yield the rows one at a time,
+    fetching them from SQLite in chunks of chunk_size, so large
+    results needn't fit in memory. Nothing is committed, and a
+    commit while you are still iterating ends the iteration early.
+    '''
+    chunk_size = kwargs.get('chunk_size', 1000)
+    lazy = kwargs.get('lazy', self.lazy)
+    cursor = self.connection.cursor()
+    with lazy_decoding(lazy):
+      try:
+        cursor.execute(sql, *args)
+      except self.sqlite3.InterfaceError, msg:
+        raise self.sqlite3.InterfaceError(unicode(msg) + '\nTry converting types or pickling.')
+
+    self.__after_statement(sql)
+
+    if None == cursor.description:
+      return None
+    else:
+      make_row = self.__row_maker(cursor, kwargs.get('row_factory', self.row_factory))
+      return self.__iterrows(cursor, chunk_size, make_row, lazy)
+
+  def execute_columns(self, sql, *args, **kwargs):
+    '''
+    Run a query and return its results by column, filling an array per
+    column as rows are fetched in chunks of chunk_size. Pass types, a
+    dictionary of declared types by column name, to choose the arrays;
+    the rest are guessed from the first chunk. Columns are NumPy masked
+    arrays if NumPy is installed, unless you pass numpy = False.
+    '''
+    types = kwargs.get('types', {})
+    use_numpy = kwargs.get('numpy', numpy != None)
+    if use_numpy and numpy == None:
+      raise ImportError('NumPy is not installed.')
+
+    cursor = self.connection.cursor()
+    try:
+      try:
+        cursor.execute(sql, *args)
+      except self.sqlite3.InterfaceError, msg:
+        raise self.sqlite3.InterfaceError(unicode(msg) + '\nTry converting types or pickling.')
+      self.__after_statement(sql)
+      if None == cursor.description:
+        return None
+
+      colnames = self.__colnames(cursor)
+      builders = None
+      while True:
+        rows = cursor.fetchmany(kwargs.get('chunk_size', 1000))
+        if builders == None:
+          builders = [ColumnBuilder(column_kind(types.get(name) or guess_column_type(rows, i)))
+            for i, name in enumerate(colnames)]
+        if rows == []:
+          break
+        for builder, values in zip(builders, zip(*rows)):
+          builder.extend(values)
+    finally:
+      cursor.close()
+
+    columns = Columns()
+    columns.masks = OrderedDict()
+    for name, builder in zip(colnames, builders):
+      columns[name], columns.masks[name] = builder.finish(use_numpy)
+    return columns
+
+  def __colnames(self, cursor):
+    return [d[0].decode('utf-8') for d in cursor.description]
+
+  def __row_maker(self, cursor, row_factory, colnames = None):
+    'Make raw rows from a cursor into the chosen type, or None for plain tuples.'
+    if row_factory == u'tuple':
       return None
+
+    colnames = colnames or self.__colnames(cursor)
+    if row_factory == u'ordereddict':
+      return lambda row: OrderedDict(zip(colnames,row))
+    elif row_factory == u'row':
+      return lambda row: self.sqlite3.Row(cursor, row)
+    elif row_factory == u'record':
+      return record_type(colnames)
     else:
-      colnames = [d[0].decode('utf-8') for d in self.cursor.description]
-      rawdata = [OrderedDict(zip(colnames,row)) for row in rows]
-      return rawdata
+      raise ValueError(u'row_factory must be one of %s.' % u', '.join(ROW_FACTORIES))
+
+  def __iterrows(self, cursor, chunk_size, make_row, lazy):
+    try:
+      while True:
+        with lazy_decoding(lazy):
+          rows = cursor.fetchmany(chunk_size)
+        if rows == []:
+          break
+        for row in rows:
+          yield row if make_row == None else make_row(row)
+    finally:
+      cursor.close()
 
   def commit(self):
-    'Commit database transactions.'
-    return self.connection.commit()
+    'Commit database transactions, unless a transaction block is running.'
+    if self.__transaction_depth == 0:
+      return self.connection.commit()
+
+  @contextmanager
+  def transaction(self):
+    '''
+    Run the body of a with statement in one transaction, deferring all
+    commits to its end and rolling back if it raises an exception.
+    Anything pending from before is committed when it starts. A nested
+    transaction joins the outer one; use savepoint to nest properly.
+    '''
+    if self.__transaction_depth > 0:
+      self.__transaction_depth += 1
+      try:
+        yield
+      finally:
+        self.__transaction_depth -= 1
+      return
+
+    isolation_level = self.connection.isolation_level
+
+    # The sqlite3 module commits before each DDL statement unless
+    # it leaves transactions to us. This commits anything pending.
+    self.connection.isolation_level = None
+    self.cursor.execute(u'BEGIN')
+    self.__transaction_depth = 1
+    try:
+      yield
+    except:
+      self.connection.rollback()
+      self.__forget_schema()
+      raise
+    else:
+      self.connection.commit()
+    finally:
+      self.__transaction_depth = 0
+      self.connection.isolation_level = isolation_level
+
+  @contextmanager
+  def savepoint(self):
+    'Like transaction, but only roll back the body if it is nested in another.'
+    with self.transaction():
+      name = u'dumptruck%d' % self.__transaction_depth
+      self.cursor.execute(u'SAVEPOINT %s' % name)
+      try:
+        yield
+      except:
+        self.cursor.execute(u'ROLLBACK TO %s' % name)
+        self.cursor.execute(u'RELEASE %s' % name)
+        self.__forget_schema()
+        raise
+      else:
+        self.cursor.execute(u'RELEASE %s' % name)
 
   def close(self):
     return self.connection.close()
@@ -167,25 +647,69 @@ class DumpTruck:
     params = (first_param, quote(table_name), ','.join(map(quote, columns)))
     self.execute(sql % params, **kwargs)
 
+  def __table_info(self, table_name):
+    'PRAGMA table_info for a table, remembered until the schema changes.'
+    self.__check_schema_version()
+    key = quote(table_name)[1:-1].lower()
+    try:
+      return self.__table_infos[key]
+    except KeyError:
+      # This is vulnerable to injection.
+      self.cursor.execute(u'PRAGMA table_info(%s)' % quote(table_name))
+      table_info = self.cursor.fetchall()
+
+      # Don't remember tables that aren't there yet.
+      if table_info != []:
+        self.__table_infos[key] = table_info
+      return table_info
+
   def __column_types(self, table_name):
-    # This is vulnerable to injection.
-    self.cursor.execute(u'PRAGMA table_info(%s)' % quote(table_name))
-    return {column[1]:column[2] for column in self.cursor.fetchall()}
+    return {column[1]:column[2] for column in self.__table_info(table_name)}
 
-  def __check_and_add_columns(self, table_name, converted_data_row):
-    column_types = self.__column_types(table_name)
-    for key,value in converted_data_row:
-      try:
+  def __infer_columns(self, converted_data, existing = ()):
+    '''
+    Scan converted rows for the columns that aren't in existing, and
+    decide each one's type from all of its values. Returns quoted
+    names and types, in order of appearance, by lowercase name.
+    '''
+    seen = OrderedDict()
+    for row in converted_data:
+      for key,value in row:
+        name = key[1:-1].lower()
+        if name in existing:
+          continue
         column_type = get_column_type(value)
-        params = (quote(table_name), key, column_type)
-        sql = u'ALTER TABLE %s ADD COLUMN %s %s ' % params
-        self.execute(sql, commit = True)
-      except self.sqlite3.OperationalError, msg:
-        if str(msg).split(':')[0] == u'duplicate column name':
-          # The column is already there.
-          pass
+        try:
+          column_types = seen[name][1]
+        except KeyError:
+          seen[name] = (key, [column_type])
         else:
-          raise
+          if column_type not in column_types:
+            column_types.append(column_type)
+
+    return OrderedDict((name, (key, common_column_type(column_types))) for name, (key, column_types) in seen.items())
+
+  def __check_and_add_columns(self, table_name, converted_data):
+    existing = set(name.lower() for name in self.__column_types(table_name))
+    new_columns = self.__infer_columns(converted_data, existing)
+
+    if len(new_columns) == 0:
+      return
+
+    self.__forget_results(table_name)
+    with self.transaction():
+      for key, column_type in new_columns.values():
+        try:
+          params = (quote(table_name), key, column_type)
+          sql = u'ALTER TABLE %s ADD COLUMN %s %s ' % params
+          self.cursor.execute(sql)
+        except self.sqlite3.OperationalError, msg:
+          if str(msg).split(':')[0] == u'duplicate column name':
+            # Someone else added the column.
+            pass
+          else:
+            raise
+    self.__table_infos.pop(quote(table_name)[1:-1].lower(), None)
 
   def __cast_data_to_column_type(self, data):
     column_types = self.__column_types(table_name)
@@ -198,107 +722,421 @@ class DumpTruck:
 
   def create_table(self, data, table_name, error_if_exists = False, **kwargs):
     'Create a table based on the data, but don\'t insert anything.'
-
     converted_data = convert(data)
-    if len(converted_data) == 0 or converted_data[0] == []:
-      raise ValueError(u'You passed no sample values, or all the values you passed were null.')
-    else:
-      startdata = OrderedDict(converted_data[0])
-
-    # Select a non-null item
-    for k, v in startdata.items():
-      if v != None:
-        break
-    else:
-      v = None
+    self.__create_table(converted_data, table_name, error_if_exists)
 
-    if_not_exists = u'' if error_if_exists else u'IF NOT EXISTS'
+    # The table might have been there already.
+    if not error_if_exists:
+      self.__check_and_add_columns(table_name, converted_data)
 
-    # Do nothing if all items are null.
-    if v != None:
-      try:
-        # This is vulnerable to injection.
-        sql = u'''
-          CREATE TABLE %s %s (
-            %s %s
-          );''' % (if_not_exists, quote(table_name), quote(k), get_column_type(startdata[k]))
-        self.execute(sql, commit = False)
-      except:
-        raise
-      else:
-        self.commit()
+  def __create_table(self, converted_data, table_name, error_if_exists):
+    'Create a table with every column that appears in the data.'
+    if all(row == [] for row in converted_data):
+      raise ValueError(u'You passed no sample values, or all the values you passed were null.')
 
-      for row in converted_data:
-        self.__check_and_add_columns(table_name, row)
+    if_not_exists = u'' if error_if_exists else u'IF NOT EXISTS'
+    columns = self.__infer_columns(converted_data).values()
 
+    # This is vulnerable to injection.
+    sql = u'''
+      CREATE TABLE %s %s (
+        %s
+      );''' % (if_not_exists, quote(table_name), u',\n        '.join(u'%s %s' % column for column in columns))
+    self.__forget_results(table_name)
+    self.execute(sql, commit = False)
+    self.commit()
 
-  def insert(self, data, table_name = 'dumptruck', upsert = False, **kwargs):
+  def insert(self, data, table_name = 'dumptruck', upsert = False, merge = False, key = None, detect_changes = None, **kwargs):
+    if detect_changes not in (None, u'columns', u'hash'):
+      raise ValueError(u'detect_changes must be None, "columns" or "hash"')
+    merge = merge or key != None or detect_changes != None
     if upsert:
       upserttext=' OR REPLACE'
     else:
       upserttext=''
 
+    # How many rows were inserted, updated and skipped, if we are counting
+    counts = None if detect_changes == None else {u'inserted': 0, u'updated': 0, u'skipped': 0}
+
     # Skip if empty
     if len(data) == 0 and not hasattr(data, 'keys'):
-      return []
-
-    try:
-      self.create_table(data, table_name, error_if_exists = True)
-    except ValueError, msg_raw:
-      msg = unicode(msg_raw)
-      msgs = {
-        u'Data must contain at least one row.',
-        u'First data row must contain at least one column.',
-        u'You passed no sample values, or all the values you passed were null.'
-      }
-
-      if table_name in self.tables() and msg in msgs:
-        pass
-      else:
-        raise
-    except self.sqlite3.OperationalError, msg_raw:
-      if 'already exists' in msg_raw:
-        pass
-    except:
-      raise
+      return [] if counts == None else counts
 
     # Turn it into a list of zips.
     converted_data = convert(data)
 
-    for row in converted_data:
-      self.__check_and_add_columns(table_name, row)
+    # Once a table has row hashes, every write has to keep them current. Merges
+    # can't hash the rows they update without reading them, so they clear the hash.
+    hashed = detect_changes == u'hash' or HASH_COLUMN in (column[1].lower() for column in self.__table_info(table_name))
+    clear_hash = hashed and merge and detect_changes != u'hash'
+    if hashed and not clear_hash:
+      converted_data = [row + [(quote(HASH_COLUMN), self.__row_hash(row))] for row in converted_data]
+
+    self.__prepare_table(table_name, converted_data)
 
     # .keys() and .items() are in the same order
     # http://www.python.org/dev/peps/pep-3106/
 
-    # rowid of inserted rows
-    rowids = []
-    for row in converted_data:
-      keys = [pair[0] for pair in row]
-      values = [pair[1] for pair in row]
+    rowid_aliases = self.__rowid_aliases(table_name)
+    if merge and key == None:
+      key = self.__unique_key(table_name)
 
-      # This is vulnerable to injection.
-      if len(keys) > 0:
-        question_marks = ','.join('?'*len(keys))
-        sql = u'INSERT %s INTO %s (%s) VALUES (%s);' % (upserttext, quote(table_name), ','.join(keys), question_marks)
-        self.execute(sql, values, commit=False)
+    self.__forget_results(table_name)
 
-      else:
-        sql = u'INSERT %s INTO %s DEFAULT VALUES;' % (upserttext, quote(table_name))
-        self.execute(sql, commit=False)
+    # Put the columns in one order so that rows with the same columns
+    # share a batch and a statement, whatever order they came in.
+    for row in converted_data:
+      row.sort(key = itemgetter(0))
 
-      rowids.append(self.execute('SELECT last_insert_rowid()', commit=False)[0]['last_insert_rowid()'])
+    # rowid of inserted rows
+    rowids = []
+    for keys, rows in groupby(converted_data, lambda row: tuple(pair[0] for pair in row)):
+      values = [[pair[1] for pair in row] for row in rows]
+      if merge:
+        rowids.extend(self.__merge_batch(table_name, keys, values, key, counts, clear_hash))
+      else:
+        rowids.extend(self.__insert_batch(table_name, keys, values, upserttext, rowid_aliases))
 
     self.__commit_if_necessary(kwargs)
 
     # Return rowids as a list?
-    if hasattr(data, 'keys'):
+    if counts != None:
+      return counts
+    elif hasattr(data, 'keys'):
       return rowids[0]
     else:
       return rowids
 
+  def __prepare_table(self, table_name, converted_data):
+    'Make sure that a table exists and has the columns of some converted rows.'
+    if self.__table_info(table_name) == []:
+      try:
+        self.__create_table(converted_data, table_name, error_if_exists = True)
+      except self.sqlite3.OperationalError, msg:
+        if u'already exists' not in unicode(msg):
+          raise
+        # Someone else just made it.
+        self.__check_and_add_columns(table_name, converted_data)
+    else:
+      self.__check_and_add_columns(table_name, converted_data)
+
+  def insert_columns(self, columns, table_name = 'dumptruck', **kwargs):
+    '''
+    Insert rows given by column, as a dictionary of equally long
+    sequences, like dump_columns returns. Each column's type is decided
+    from its first value that isn't None, and the rows are passed to
+    SQLite without a dictionary per row. Returns the number of rows.
+    '''
+    names = list(columns.keys())
+    checkkeys(names)
+    if len(set(name.lower() for name in names)) != len(names):
+      raise ValueError(u'You passed the same column name twice. (Column names are insensitive to case.)')
+    lengths = set(len(columns[name]) for name in names)
+    if len(lengths) > 1:
+      raise ValueError(u'The columns must all be the same length.')
+
+    if len(lengths) == 0 or lengths == set([0]):
+      return 0
+
+    # Columns from dump_columns come with masks of their NULLs.
+    masks = getattr(columns, 'masks', {})
+    kept, sample = [], []
+    for name in names:
+      # Leave out columns that are all None, as insert leaves out None values.
+      first = next((value for value in column_values(columns[name], masks.get(name)) if value is not None), None)
+      if first is not None:
+        kept.append(name)
+        sample.append((quote(name), first))
+
+    if len(kept) == 0:
+      raise ValueError(u'You passed no sample values, or all the values you passed were null.')
+    self.__prepare_table(table_name, [sample])
+    values = [column_values(columns[name], masks.get(name)) for name in kept]
+
+    self.__forget_results(table_name)
+    sql = self.__insert_sql((table_name, u'', tuple(key for key, first in sample)))
+    self.__execute_dml(self.cursor.executemany, sql, izip(*values))
+    self.__commit_if_necessary(kwargs)
+    return lengths.pop()
+
+  def insert_cache_info(self):
+    'Hits, misses, maximum size and current size of the cache of INSERT statements.'
+    return self.__insert_sql.cache_info()
+
+  def __build_insert_sql(self, statement):
+    '''
+    The SQL for an insert, given the table name, the mode (upserttext,
+    or the key columns to merge on and whether to clear the row hash)
+    and the quoted columns.
+    '''
+    table_name, mode, keys = statement
+    table = quote(table_name)
+    if type(mode) == tuple:
+      return self.__build_merge_sql(table, mode[0], keys, mode[1])
+
+    # This is vulnerable to injection.
+    if len(keys) > 0:
+      question_marks = ','.join('?'*len(keys))
+      return u'INSERT %s INTO %s (%s) VALUES (%s);' % (mode, table, ','.join(keys), question_marks)
+    else:
+      return u'INSERT %s INTO %s DEFAULT VALUES;' % (mode, table)
+
+  def __build_merge_sql(self, table, key, keys, clear_hash = False):
+    '''
+    The SQL for merging rows on a key, given the quoted table and columns.
+    If clear_hash, the hash of each row that changes is set to NULL.
+    '''
+    key_names = [quote(column)[1:-1].lower() for column in key]
+
+    # Only overwrite the columns that were passed, and only if they changed.
+    # If the rows have a hash of their values, that's all we need to compare.
+    updates = [k for k in keys if k[1:-1].lower() not in key_names]
+    compared = [quote(HASH_COLUMN)] if quote(HASH_COLUMN) in keys else updates
+    if updates:
+      assignments = [u'%s = excluded.%s' % (k, k) for k in updates]
+      if clear_hash:
+        assignments.append(u'%s = NULL' % quote(HASH_COLUMN))
+      action = u'DO UPDATE SET %s WHERE %s' % (
+        u', '.join(assignments),
+        u' OR '.join(u'%s.%s IS NOT excluded.%s' % (table, k, k) for k in compared),
+      )
+    else:
+      action = u'DO NOTHING'
+
+    # This is vulnerable to injection.
+    return u'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) %s;' % (
+      table, ','.join(keys), ','.join('?'*len(keys)), ','.join(map(quote, key)), action)
+
+  def __insert_batch(self, table_name, keys, values, upserttext, rowid_aliases):
+    'Insert rows that share one set of columns, and return their rowids.'
+    sql = self.__insert_sql((table_name, upserttext, keys))
+
+    # SQLite numbers a batch consecutively only if it picks the rowids itself,
+    # so replacements and explicit rowids go one row at a time.
+    sets_rowid = any(key[1:-1].lower() in rowid_aliases for key in keys)
+    if upserttext or sets_rowid or len(values) == 1:
+      rowids = []
+      for row in values:
+        self.__execute_dml(self.cursor.execute, sql, row)
+        rowids.append(self.cursor.lastrowid)
+      return rowids
+
+    self.__execute_dml(self.cursor.executemany, sql, values)
+    self.cursor.execute(u'SELECT last_insert_rowid()')
+    last_rowid = self.cursor.fetchone()[0]
+    return range(last_rowid - len(values) + 1, last_rowid + 1)
+
+  def __row_hash(self, row):
+    'A digest of the values in a converted row, whatever order its columns are in.'
+    pairs = sorted((k.lower(), self.__hash_value(value)) for k, value in row)
+    return unicode(hashlib.sha1(repr(pairs)).hexdigest())
+
+  def __hash_value(self, value):
+    'A value as SQLite would compare it, so that equal values hash alike.'
+    # 1, 1L, 1.0 and True are all the same number to SQLite.
+    if isinstance(value, (int, long)) or (isinstance(value, float) and value.is_integer()):
+      return long(value)
+    elif isinstance(value, unicode):
+      return value
+    elif isinstance(value, str):
+      return value.decode('utf-8')
+    else:
+      return self.__adapt_var(value)
+
+  def __merge_batch(self, table_name, keys, values, key, counts = None, clear_hash = False):
+    '''
+    Insert rows that share one set of columns, updating the rows whose
+    key is already there instead, and return their rowids. If counts is
+    passed, add to its counts of inserted, updated and skipped rows instead.
+    If clear_hash, forget the hashes of the rows that get updated.
+    '''
+    names = [k[1:-1].lower() for k in keys]
+    key_names = [quote(column)[1:-1].lower() for column in key]
+    try:
+      positions = [names.index(name) for name in key_names]
+    except ValueError:
+      raise ValueError(u'Every row needs a value for each of the key columns, %s' % u', '.join(key))
+
+    sql = self.__insert_sql((table_name, (tuple(key), clear_hash), keys))
+    key_values = [[row[p] for p in positions] for row in values]
+
+    if counts == None:
+      self.__execute_dml(self.cursor.executemany, sql, values)
+
+      # last_insert_rowid() doesn't change on updates, so look the rows up by key.
+      return self.__rowids_by_key(table_name, key, key_values)
+
+    # Rows whose keys aren't there yet get inserted, and the rest of the
+    # rows that SQLite changed got updated.
+    existing = self.__rowids_by_key(table_name, key, key_values)
+    new = set(tuple(row) for row, rowid in zip(key_values, existing) if rowid == None)
+    self.__execute_dml(self.cursor.executemany, sql, values)
+    changed = self.cursor.rowcount
+    counts[u'inserted'] += len(new)
+    counts[u'updated'] += changed - len(new)
+    counts[u'skipped'] += len(values) - changed
+    return []
+
+  def __rowids_by_key(self, table_name, key, key_values):
+    'The rowid of the row with each of the key values.'
+    table = quote(table_name)
+    columns = [quote(column) for column in key]
+    chunk_size = MAX_PARAMETERS // (len(columns) + 1)
+    rowids = [None] * len(key_values)
+    for start in range(0, len(key_values), chunk_size):
+      chunk = key_values[start:start + chunk_size]
+
+      # SQLite compares the keys, so they match however they were adapted.
+      # The values are columns column1 (the position), column2 and so on.
+      sql = u'WITH `keys` AS (VALUES %s) SELECT `keys`.column1, %s.rowid FROM `keys` JOIN %s ON %s' % (
+        ','.join([u'(%s)' % ','.join('?'*(len(columns) + 1))] * len(chunk)),
+        table, table,
+        u' AND '.join(u'%s.%s = `keys`.column%d' % (table, c, n) for n, c in enumerate(columns, 2)),
+      )
+      params = [value for i, row in enumerate(chunk, start) for value in [i] + row]
+      self.cursor.execute(sql, params)
+      for i, rowid in self.cursor.fetchall():
+        rowids[i] = rowid
+    return rowids
+
+  def __unique_key(self, table_name):
+    'The columns of the only unique index on a table.'
+    # This is vulnerable to injection.
+    self.cursor.execute(u'PRAGMA index_list(%s)' % quote(table_name))
+    indices = [index[1] for index in self.cursor.fetchall() if index[2] and not index[4]]
+    if len(indices) != 1:
+      raise ValueError(u'Pass the key columns; %s has %d unique indices' % (table_name, len(indices)))
+    self.cursor.execute(u'PRAGMA index_info(%s)' % quote(indices[0]))
+    return [column[2] for column in self.cursor.fetchall()]
+
+  def __execute_dml(self, method, sql, params):
+    'Run a data-changing statement without building any result rows.'
+    try:
+      method(sql, params)
+    except self.sqlite3.InterfaceError, msg:
+      raise self.sqlite3.InterfaceError(unicode(msg) + '\nTry converting types or pickling.')
+
+  def __rowid_aliases(self, table_name):
+    'Lowercase names that refer to the rowid of a table.'
+    aliases = {u'rowid', u'oid', u'_rowid_'}
+    primary_keys = [column for column in self.__table_info(table_name) if column[5]]
+    if len(primary_keys) == 1 and primary_keys[0][2].upper() == u'INTEGER':
+      aliases.add(primary_keys[0][1].lower())
+    return aliases
+
+  def insert_stream(self, data, table_name = 'dumptruck', chunk_size = 1000, progress = None, upsert = False):
+    '''
+    Insert rows from any iterable, like a generator, without holding
+    them all in memory. They are inserted and committed chunk_size at a
+    time, and columns are added as new keys turn up. After each chunk,
+    progress is called with the number of rows inserted so far, which
+    is also what this returns.
+    '''
+    if type(chunk_size) not in [int, long] or chunk_size < 1:
+      raise ValueError('chunk_size must be a positive integer')
+
+    rows = iter([data] if hasattr(data, 'keys') else data)
+    count = 0
+    while True:
+      chunk = list(islice(rows, chunk_size))
+      if chunk == []:
+        return count
+
+      self.insert(chunk, table_name, upsert = upsert, commit = True)
+      count += len(chunk)
+      if progress != None:
+        progress(count)
+
+  def import_csv(self, path, table_name = 'dumptruck', chunk_size = 10000, sample_size = 1000, progress = None, encoding = 'utf-8', **kwargs):
+    '''
+    Import a CSV file whose first row names the columns. Each column's
+    type is inferred from the first sample_size rows; empty values are
+    NULL. The rows go to SQLite as tuples, chunk_size at a time, each
+    chunk in one transaction, and progress is called with the number of
+    rows so far after each chunk. Other keyword arguments go to
+    csv.reader. Returns an ImportSummary.
+    '''
+    if type(chunk_size) not in [int, long] or chunk_size < 1:
+      raise ValueError('chunk_size must be a positive integer')
+
+    started = default_timer()
+    with open(path, 'rb') as f:
+      reader = csv.reader(f, **kwargs)
+      names = [name.decode(encoding) for name in next(reader, [])]
+      if len(names) == 0:
+        raise ValueError(u'%s has no header row to name the columns.' % path)
+
+      # csv.reader yields blank lines as empty rows.
+      records = (row for row in reader if row != [])
+      sample = list(islice(records, sample_size))
+      parsers = infer_parsers(sample, len(names), encoding)
+      width = len(names)
+
+      def parse_row(row):
+        if len(row) > width:
+          raise ValueError(u'Line %d of %s has more values than there are columns.' % (reader.line_num, path))
+        try:
+          return [parse(value) for parse, value in izip(parsers, row)] + [None] * (width - len(row))
+        except ValueError, msg:
+          raise ValueError(u'Line %d of %s: %s' % (reader.line_num, path, msg))
+
+      # Make the table from the sample, with text columns for any that it left empty.
+      sample = [parse_row(row) for row in sample]
+      schema_rows = [OrderedDict(zip(names, row)) for row in sample]
+      empty = [name for i, name in enumerate(names) if all(row[i] is None for row in sample)]
+      if empty:
+        schema_rows.append(OrderedDict((name, u'') for name in empty))
+      self.__prepare_table(table_name, convert(schema_rows))
+
+      sql = self.__insert_sql((table_name, u'', tuple(quote(name) for name in names)))
+      def load(chunk):
+        self.__execute_dml(self.cursor.executemany, sql, chunk)
+
+      rows = chain(sample, (parse_row(row) for row in records))
+      count = self.__import_chunks(table_name, rows, chunk_size, load, progress)
+    return summarize(count, default_timer() - started)
+
+  def import_jsonl(self, path, table_name = 'dumptruck', chunk_size = 10000, sample_size = 1000, progress = None):
+    '''
+    Import a JSON Lines file, with one object per line. The table is made
+    from the first sample_size objects, and later ones can add columns.
+    The rows are inserted chunk_size at a time, each chunk in one
+    transaction, and progress is called with the number of rows so far
+    after each chunk. Returns an ImportSummary.
+    '''
+    if type(chunk_size) not in [int, long] or chunk_size < 1:
+      raise ValueError('chunk_size must be a positive integer')
+
+    started = default_timer()
+    with open(path, 'rb') as f:
+      rows = (json.loads(line) for line in f if line.strip())
+      sample = list(islice(rows, sample_size))
+      if sample:
+        self.__prepare_table(table_name, convert(sample))
+
+      def load(chunk):
+        self.insert(chunk, table_name, commit = False)
+
+      count = self.__import_chunks(table_name, chain(sample, rows), chunk_size, load, progress)
+    return summarize(count, default_timer() - started)
+
+  def __import_chunks(self, table_name, rows, chunk_size, load, progress):
+    'Load rows chunk_size at a time, each chunk in one transaction, and count them.'
+    count = 0
+    while True:
+      chunk = list(islice(rows, chunk_size))
+      if chunk == []:
+        return count
+
+      self.__forget_results(table_name)
+      with self.transaction():
+        load(chunk)
+      count += len(chunk)
+      if progress != None:
+        progress(count)
+
   def upsert(self, *args, **kwargs):
-    self.insert(upsert=True, *args, **kwargs)
+    return self.insert(upsert=True, *args, **kwargs)
 
   def __commit_if_necessary(self, kwargs):
     if kwargs.get('commit', self.auto_commit):
@@ -306,74 +1144,94 @@ class DumpTruck:
 
   def get_var(self, key):
     'Retrieve one saved variable from the database.'
-    vt = quote(self.__vars_table)
-    data = self.execute(u'SELECT * FROM %s WHERE `key` = ?' % vt, [key], commit = False)
-    if data == []:
-      raise NameError(u'The DumpTruck variables table doesn\'t have a value for %s.' % key)
+    return self.get_vars([key])[key]
+
+  def __convert_var(self, value, column_type):
+    'Convert a stored variable as if it came from a column of its type.'
+    # Converters are chosen by the first word of the type, like PARSE_DECLTYPES.
+    converter = self.sqlite3.converters.get((column_type or u'').split(u' ')[0].upper())
+    if value == None or converter == None:
+      return value
+    elif isinstance(value, unicode):
+      return converter(value.encode('utf-8'))
     else:
-      tmp = quote(self.__vars_table_tmp)
-      row = data[0]
+      return converter(str(value))
 
-      self.execute(u'DROP TABLE IF EXISTS %s' % tmp, commit = False)
+  def __adapt_var(self, value):
+    'Adapt a variable for storage with whichever adapter sqlite3 would use.'
+    # __class__ rather than type() so that old-style classes like Pickle work
+    adapter = self.sqlite3.adapters.get((value.__class__, self.sqlite3.PrepareProtocol))
+    return value if adapter == None else adapter(value)
 
-      # This is vulnerable to injection
-      self.execute(u'CREATE TEMPORARY TABLE %s (`value` %s)' % (tmp, row['type']), commit = False)
+  def get_vars(self, keys):
+    'Retrieve several saved variables from the database, as a dictionary.'
+    keys = list(keys)
+    self.__check_data_version()
+    missing = [key for key in keys if key not in self.__vars]
 
-      # This is ugly
-      self.execute(u'INSERT INTO %s (`value`) VALUES (?)' % tmp, [row['value']], commit = False)
-      value = self.dump(tmp)[0]['value']
-      self.execute(u'DROP TABLE %s' % tmp, commit = False)
+    # Stay under SQLite's limit on the number of parameters.
+    vt = quote(self.__vars_table)
+    for i in range(0, len(missing), VARS_CHUNK_SIZE):
+      chunk = missing[i:i + VARS_CHUNK_SIZE]
+      sql = u'SELECT `key`, `value`, `type` FROM %s WHERE `key` IN (%s)' % (vt, ','.join('?'*len(chunk)))
+      for key, value, column_type in self.execute(sql, chunk, commit = False, row_factory = u'tuple'):
+        self.__vars[key] = (value, column_type)
 
-      return value
+    missing = [key for key in keys if key not in self.__vars]
+    if missing != []:
+      raise NameError(u'The DumpTruck variables table doesn\'t have a value for %s.' % u', '.join(map(unicode, missing)))
+
+    return {key: self.__convert_var(*self.__vars[key]) for key in keys}
 
   def save_var(self, key, value, **kwargs):
     'Save one variable to the database.'
+    self.save_vars({key: value}, **kwargs)
+
+  def save_vars(self, mapping, **kwargs):
+    'Save several variables to the database in one transaction.'
 
     # Check whether Highwall's variables table exists
     self.__check_or_create_vars_table()
 
-    column_type = get_column_type(value)
-    tmp = quote(self.__vars_table_tmp)
-
-    self.execute(u'DROP TABLE IF EXISTS %s' % tmp, commit = False)
-
-    # This is vulnerable to injection
-    self.execute(u'CREATE TABLE %s (`value` %s)' % (tmp, column_type), commit = False)
+    params = [[key, get_column_type(value), self.__adapt_var(value)] for key, value in mapping.items()]
+    sql = u'INSERT OR REPLACE INTO %s (`key`, `type`, `value`) VALUES (?, ?, ?)' % quote(self.__vars_table)
+    self.__forget_results(self.__vars_table)
+    self.__execute_dml(self.cursor.executemany, sql, params)
 
-    # This is ugly
-    self.execute(u'INSERT INTO %s (`value`) VALUES (?)' % tmp, [value], commit = False)
-    table = (quote(self.__vars_table), tmp)
-    params = [key, column_type]
-    self.execute(u'''
-INSERT OR REPLACE INTO %s (`key`, `type`, `value`)
-  SELECT
-    ? AS key,
-    ? AS type,
-    value
-  FROM %s
-''' % table, params)
-    self.execute(u'DROP TABLE %s' % tmp, commit = False)
+    # Read them back from the database next time, in their stored form.
+    for key in mapping.keys():
+      self.__vars.pop(key, None)
 
     self.__commit_if_necessary(kwargs)
 
   def tables(self):
-    result = self.execute(u'SELECT name FROM sqlite_master WHERE TYPE="table"', commit=False)
-    return set([row['name'] for row in result])
+    result = self.execute(u'SELECT name FROM sqlite_master WHERE TYPE="table"', commit=False, row_factory = u'tuple')
+    return set([row[0] for row in result])
 
   def tablesAndViews(self):
       """Return a sequence of (name,type) pairs where type is
       either "table" or "view"."""
       result = self.execute(
         u'SELECT name,type FROM sqlite_master WHERE type in ("table", "view")',
-        commit=False)
-      return ((row['name'],row['type']) for row in result)
+        commit=False, row_factory = u'tuple')
+      return ((row[0],row[1]) for row in result)
 
 
   def drop(self, table_name = 'dumptruck', if_exists = False, **kwargs):
     'Drop a table.'
+    self.__forget_results(table_name)
     return self.execute(u'DROP TABLE %s %s;' % ('IF EXISTS' if if_exists else '', quote(table_name)), **kwargs)
 
-  def dump(self, table_name = 'dumptruck'):
+  def dump(self, table_name = 'dumptruck', **kwargs):
     'Dump a table.'
-    return self.execute(u'SELECT * FROM %s;' % quote(table_name))
+    return self.execute(u'SELECT * FROM %s;' % quote(table_name), **kwargs)
+
+  def iterdump(self, table_name = 'dumptruck', **kwargs):
+    'Dump a table one row at a time.'
+    return self.iterexecute(u'SELECT * FROM %s;' % quote(table_name), **kwargs)
+
+  def dump_columns(self, table_name = 'dumptruck', **kwargs):
+    "Dump a table by column, with arrays chosen by the columns' declared types."
+    kwargs.setdefault('types', self.__column_types(table_name))
+    return self.execute_columns(u'SELECT * FROM %s;' % quote(table_name), **kwargs)
 
@@ -0,0 +1,120 @@
+#!/usr/bin/env python2
+'Parsing CSV values for DumpTruck.import_csv'
+
+# This file is part of DumpTruck.
+
+# Copyright (C) 2012 ScraperWiki Ltd. and other contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+import re
+import math
+from collections import namedtuple
+from adapters_and_converters import DATE, DATETIME, convert_date, convert_datetime
+
+ImportSummary = namedtuple('ImportSummary', ['rows', 'seconds', 'rows_per_second'])
+
+def summarize(rows, seconds):
+  'How many rows an import loaded, and how fast.'
+  return ImportSummary(rows, seconds, rows / seconds if seconds > 0 else float(rows))
+
+# Leading zeroes are usually part of a code, like a phone number.
+LEADING_ZERO = re.compile(r'\s*[+-]?0\d')
+
+INTEGER = re.compile(r'\s*[+-]?\d+\s*$')
+
+# The integers that SQLite can store
+MIN_INTEGER, MAX_INTEGER = -2 ** 63, 2 ** 63 - 1
+
+def parse_integer(text):
+  if LEADING_ZERO.match(text):
+    raise ValueError('%s has a leading zero' % text)
+  value = int(text)
+  if not MIN_INTEGER <= value <= MAX_INTEGER:
+    raise ValueError('%s is too big for SQLite' % text)
+  return value
+
+def parse_real(text):
+  if LEADING_ZERO.match(text):
+    raise ValueError('%s has a leading zero' % text)
+  # Integers too big to store are usually identifiers, whose digits
+  # would be lost as reals, so they stay text.
+  if INTEGER.match(text) and not MIN_INTEGER <= int(text) <= MAX_INTEGER:
+    raise ValueError('%s is too big for SQLite' % text)
+  value = float(text)
+  # float takes "NaN" and "inf", which are more likely to be words.
+  if math.isnan(value) or math.isinf(value):
+    raise ValueError('%s is not a finite number' % text)
+  return value
+
+def parse_date(text):
+  if DATE.match(text) == None:
+    raise ValueError('%s is not a date' % text)
+  return convert_date(text)
+
+def parse_datetime(text):
+  if DATETIME.match(text) == None:
+    raise ValueError('%s is not a datetime' % text)
+  return convert_datetime(text)
+
+# The types a CSV column can be parsed as, narrowest first
+PARSERS = [parse_integer, parse_real, parse_date, parse_datetime]
+
+def infer_parsers(sample, width, encoding):
+  '''
+  Choose a parser for each of width columns of CSV rows: the first one
+  in PARSERS that takes all of the column's values in the sample rows,
+  or decoding text if none do.
+  '''
+  parsers = []
+  for i in range(width):
+    values = [row[i] for row in sample if i < len(row) and row[i] != '']
+    for parser in PARSERS:
+      try:
+        for value in values:
+          parser(value)
+      except (ValueError, TypeError):
+        continue
+      parsers.append(lenient(parser, encoding))
+      break
+    else:
+      parsers.append(lambda text: None if text == '' else text.decode(encoding))
+  return parsers
+
+# Column types whose converters can't read anything else back
+STRICT = {parse_date: u'date', parse_datetime: u'datetime'}
+
+def lenient(parser, encoding):
+  '''
+  Parse a CSV value, keeping it as text if it is different from the
+  sample. Values that a date or datetime column couldn't read back, and
+  integers that a numeric column would turn into reals, raise ValueError.
+  '''
+  def parse(text):
+    if text == '':
+      return None
+    try:
+      return parser(text)
+    except (ValueError, TypeError):
+      if parser in STRICT:
+        raise ValueError(u'%s is not a %s, like the values above it.' % (text.decode(encoding), STRICT[parser]))
+      elif INTEGER.match(text):
+        # Like 02139 or a huge identifier, whose digits would be lost
+        raise ValueError(u'%s would lose its digits in a numeric column.' % text)
+      return text.decode(encoding)
+  return parse
@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+'One DumpTruck per thread on a shared database file'
+
+# This file is part of DumpTruck.
+
+# Copyright (C) 2012 ScraperWiki Ltd. and other contributors
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import threading
+from dumptruck import DumpTruck
+
+class DumpTruckPool:
+  '''
+  Give each thread its own DumpTruck, and thus its own connection,
+  on the same database file. The DumpTrucks share one schema cache,
+  and sqlite3's adapters and converters are registered for the whole
+  process anyway. Other methods are passed on to the calling thread's
+  DumpTruck, so you can use a pool like a DumpTruck.
+  '''
+
+  def __init__(self, dbname = 'dumptruck.db', **kwargs):
+    if type(dbname) not in [unicode, str]:
+      raise TypeError('dbname must be a string')
+    elif dbname == ':memory:':
+      raise ValueError('Each thread would get its own in-memory database.')
+    elif 'schema_cache' in kwargs:
+      raise TypeError('DumpTruckPool manages the schema cache itself.')
+
+    self.dbname = dbname
+    self.__kwargs = kwargs
+    self.__schema_cache = {}
+    self.__local = threading.local()
+
+    # Check the parameters now rather than in the first thread.
+    self.get()
+
+  def get(self):
+    "The calling thread's DumpTruck"
+    try:
+      return self.__local.dumptruck
+    except AttributeError:
+      dt = DumpTruck(self.dbname, schema_cache = self.__schema_cache, **self.__kwargs)
+      self.__local.dumptruck = dt
+      return dt
+
+  def close(self):
+    '''
+    Close the calling thread's connection. Other threads'
+    connections close when those threads finish.
+    '''
+    dt = getattr(self.__local, 'dumptruck', None)
+    if dt != None:
+      del(self.__local.dumptruck)
+      dt.close()
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return getattr(self.get(), name)
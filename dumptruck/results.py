@@ -0,0 +1,118 @@
+#!/usr/bin/env python2
+'A cache of query results'
+
+# This file is part of DumpTruck.
+
+# Copyright (C) 2012 ScraperWiki Ltd. and other contributors
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+import datetime
+from copy import deepcopy
+from collections import OrderedDict, namedtuple
+
+ResultCacheInfo = namedtuple('ResultCacheInfo', ['hits', 'misses', 'results', 'rows', 'bytes'])
+
+# Values that can't be changed in place, so callers can share them
+IMMUTABLE = (type(None), bool, int, long, float, basestring, buffer, datetime.date)
+
+def is_mutable(rows):
+  'Whether any of the values in some rows could be changed in place.'
+  return any(not isinstance(value, IMMUTABLE) for row in rows for value in row)
+
+def copy_rows(rows):
+  'Rows with copies of their mutable values, like decoded JSON.'
+  return [tuple(value if isinstance(value, IMMUTABLE) else deepcopy(value) for value in row) for row in rows]
+
+def approximate_size(rows):
+  'Roughly how many bytes the values in some rows take up.'
+  size = 0
+  for row in rows:
+    for value in row:
+      size += len(value) if isinstance(value, (basestring, buffer)) else 8
+  return size
+
+class ResultCache:
+  '''
+  Query results by query, along with the tables that each one read.
+  The least recently used results are forgotten once there are more
+  than max_rows rows or max_bytes bytes of them.
+  '''
+
+  def __init__(self, max_rows = None, max_bytes = None):
+    self.max_rows = max_rows
+    self.max_bytes = max_bytes
+    self.hits = self.misses = 0
+    self.rows = self.bytes = 0
+
+    # (tables, column names, rows, size) by query
+    self.__results = OrderedDict()
+
+  def get(self, key):
+    'The column names and rows for a query, or None.'
+    try:
+      result = self.__results.pop(key)
+    except KeyError:
+      self.misses += 1
+      return None
+
+    # It's the most recently used now.
+    self.__results[key] = result
+    self.hits += 1
+
+    # Callers get their own copies of values they could change.
+    tables, colnames, rows, size, mutable = result
+    return colnames, copy_rows(rows) if mutable else list(rows)
+
+  def put(self, key, tables, colnames, rows):
+    'Remember the results of a query that read some tables.'
+    self.__forget(key)
+    size = approximate_size(rows)
+    if self.__too_big(len(rows), size):
+      return
+
+    while self.__too_big(self.rows + len(rows), self.bytes + size):
+      self.__forget(next(iter(self.__results)))
+    mutable = is_mutable(rows)
+    rows = copy_rows(rows) if mutable else list(rows)
+    self.__results[key] = (frozenset(tables), colnames, rows, size, mutable)
+    self.rows += len(rows)
+    self.bytes += size
+
+  def invalidate(self, table):
+    'Forget the results that read a table, given its lowercase name.'
+    for key, result in self.__results.items():
+      if table in result[0]:
+        self.__forget(key)
+
+  def clear(self):
+    self.__results.clear()
+    self.rows = self.bytes = 0
+
+  def info(self):
+    return ResultCacheInfo(self.hits, self.misses, len(self.__results), self.rows, self.bytes)
+
+  def __forget(self, key):
+    result = self.__results.pop(key, None)
+    if result != None:
+      self.rows -= len(result[2])
+      self.bytes -= result[3]
+
+  def __too_big(self, rows, size):
+    return (self.max_rows != None and rows > self.max_rows) or \
+      (self.max_bytes != None and size > self.max_bytes)
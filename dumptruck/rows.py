@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+'Lightweight representations of result rows'
+
+# This file is part of DumpTruck.
+
+# Copyright (C) 2012 ScraperWiki Ltd. and other contributors
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+class Record(tuple):
+  '''
+  A result row that is as small as a tuple. The column names
+  live on the class, which all rows of one result share.
+  '''
+  __slots__ = ()
+  _fields = ()
+  _index = {}
+
+  def __getitem__(self, key):
+    if isinstance(key, basestring):
+      key = self._index[key]
+    return tuple.__getitem__(self, key)
+
+  def get(self, key, default = None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def keys(self):
+    return list(self._fields)
+
+  def values(self):
+    return list(self)
+
+  def items(self):
+    return zip(self._fields, self)
+
+  def __repr__(self):
+    return u'Record(%s)' % u', '.join(u'%s=%r' % pair for pair in self.items())
+
+# Record types by column names
+RECORD_TYPES = {}
+RECORD_TYPES_MAX = 256
+
+def record_type(colnames):
+  'The Record class for a particular sequence of column names.'
+  colnames = tuple(colnames)
+  try:
+    return RECORD_TYPES[colnames]
+  except KeyError:
+    if len(RECORD_TYPES) >= RECORD_TYPES_MAX:
+      RECORD_TYPES.clear()
+
+    # Like a dictionary, the last of several same-named columns wins.
+    index = {name: i for i, name in enumerate(colnames)}
+    cls = type('Record', (Record,), {'__slots__': (), '_fields': colnames, '_index': index})
+    RECORD_TYPES[colnames] = cls
+    return cls
@@ -0,0 +1,136 @@
+#!/usr/bin/env python2
+'Load big inserts in parallel, through one SQLite file per process'
+
+# This file is part of DumpTruck.
+
+# Copyright (C) 2012 ScraperWiki Ltd. and other contributors
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+from dumptruck import DumpTruck
+from convert import quote
+
+def load_shard(task):
+  'Insert a slice of the data into a new database file, in a worker process.'
+  path, table_name, columns, rows = task
+  dt = DumpTruck(path, profile = u'bulk_load')
+
+  # Start with the target's columns so that even a slice of empty rows works.
+  definitions = u', '.join(u'%s %s' % (quote(name), column_type) for name, column_type in columns)
+  dt.execute(u'CREATE TABLE %s (%s)' % (quote(table_name), definitions))
+
+  with dt.transaction():
+    dt.insert(rows, table_name)
+  dt.close()
+  return path
+
+# How many databases SQLite lets a connection attach, unless it was built otherwise
+MAX_ATTACHED = 10
+
+def sharded_insert(dt, data, table_name = 'dumptruck', processes = None):
+  '''
+  Insert a list of rows into a table of dt, converting and writing
+  slices of it in parallel processes. Each process writes its slice
+  to a temporary database with the usual DumpTruck schema rules; the
+  slices are then attached to dt's database and copied in, in order,
+  in one transaction, so if anything fails none of the rows go in.
+  Like insert, the table and any new columns are made first, with
+  types decided from all of the rows. ATTACH doesn't work inside a transaction, so don't call this in one.
+  Returns the number of rows inserted.
+  '''
+  data = [data] if hasattr(data, 'keys') else list(data)
+  if len(data) == 0:
+    return 0
+
+  # An existing table needs no new columns for rows that are all null.
+  if table_info(dt, table_name) == [] or any(len(row) > 0 for row in data):
+    dt.create_table(data, table_name)
+  columns = [(column[1], column[2]) for column in table_info(dt, table_name)]
+
+  processes = processes or multiprocessing.cpu_count()
+  size = -(-len(data) // processes)
+  directory = tempfile.mkdtemp(prefix = 'dumptruck')
+  try:
+    tasks = [
+      (os.path.join(directory, '%d.sqlite' % i), table_name, columns, data[start:start + size])
+      for i, start in enumerate(range(0, len(data), size))
+    ]
+    pool = multiprocessing.Pool(processes)
+    try:
+      paths = pool.map(load_shard, tasks)
+    finally:
+      pool.close()
+      pool.join()
+
+    # The shards all have to be attached at once to copy them in one
+    # transaction, so if there are too many, combine some of them first.
+    databases = dt.execute(u'PRAGMA database_list', row_factory = u'tuple')
+    limit = max(MAX_ATTACHED - len([database for database in databases if database[0] > 1]), 1)
+    while len(paths) > limit:
+      paths = [combine_shards(paths[start:start + MAX_ATTACHED + 1], table_name)
+        for start in range(0, len(paths), MAX_ATTACHED + 1)]
+    merge_shards(dt, paths, table_name)
+  finally:
+    shutil.rmtree(directory)
+
+  return len(data)
+
+def table_info(dt, table_name, schema = u''):
+  'PRAGMA table_info as tuples, or [] if the table is missing'
+  sql = u'PRAGMA %stable_info(%s)' % (schema, quote(table_name))
+  return dt.execute(sql, row_factory = u'tuple') or []
+
+def combine_shards(paths, table_name):
+  'Copy the table of the other shards into the first one, and return its path.'
+  dt = DumpTruck(paths[0])
+  try:
+    merge_shards(dt, paths[1:], table_name)
+  finally:
+    dt.close()
+  return paths[0]
+
+def merge_shards(dt, paths, table_name):
+  '''
+  Copy a table from other database files into the same table of dt, in
+  order and in one transaction, so that either all of it goes in or none.
+  '''
+  attached = []
+  try:
+    for path in paths:
+      schema = u'`dumptruckshard%d`' % len(attached)
+      dt.execute(u'ATTACH DATABASE ? AS %s' % schema, [path])
+      attached.append(schema)
+
+    with dt.transaction():
+      for schema in attached:
+        shard_columns = table_info(dt, table_name, schema + u'.')
+        existing = set(column[1].lower() for column in table_info(dt, table_name))
+        names = u', '.join(quote(column[1]) for column in shard_columns)
+
+        for column in shard_columns:
+          if column[1].lower() not in existing:
+            dt.execute(u'ALTER TABLE %s ADD COLUMN %s %s' % (quote(table_name), quote(column[1]), column[2]))
+        dt.execute(u'INSERT INTO %s (%s) SELECT %s FROM %s.%s ORDER BY rowid' % (quote(table_name), names, names, schema, quote(table_name)))
+  finally:
+    for schema in attached:
+      dt.execute(u'DETACH DATABASE %s' % schema)
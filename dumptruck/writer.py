@@ -0,0 +1,199 @@
+#!/usr/bin/env python2
+'Write to a DumpTruck from many threads through one writer thread'
+
+# This file is part of DumpTruck.
+
+# Copyright (C) 2012 ScraperWiki Ltd. and other contributors
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import threading
+import Queue
+from dumptruck import DumpTruck
+
+# Tells the writer thread to finish
+STOP = object()
+
+try:
+    # Use the real thing if the futures backport is installed,
+    # so that frameworks like Tornado can wait on our futures.
+    from concurrent.futures import Future
+except ImportError:
+    class Future:
+      'The eventual result of something that another thread may not have done yet.'
+
+      def __init__(self):
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+        self.__result = None
+        self.__exception = None
+
+      def done(self):
+        return self.__done.is_set()
+
+      def result(self, timeout = None):
+        'Wait and return the result, or raise the exception.'
+        if self.exception(timeout) != None:
+          raise self.__exception
+        return self.__result
+
+      def exception(self, timeout = None):
+        'Wait and return the exception that was raised, if any.'
+        if not self.__done.wait(timeout):
+          raise RuntimeError(u'The result was not ready within %s seconds.' % timeout)
+        return self.__exception
+
+      def add_done_callback(self, callback):
+        'Call callback with the future once it is done.'
+        with self.__lock:
+          if not self.done():
+            self.__callbacks.append(callback)
+            return
+        callback(self)
+
+      def set_result(self, result):
+        self.__result = result
+        self.__finish()
+
+      def set_exception(self, exception):
+        self.__exception = exception
+        self.__finish()
+
+      def __finish(self):
+        with self.__lock:
+          self.__done.set()
+          callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+          callback(self)
+
+class DumpTruckWriter:
+  '''
+  Queue writes to a database and do them from one writer thread,
+  so that producers in other threads don't fight over SQLite's lock.
+  The writer gathers up to batch_size queued writes into each
+  transaction. Once max_pending writes are waiting, queueing more
+  blocks until the writer catches up.
+
+  insert, upsert, save_var and save_vars take the same arguments as
+  their DumpTruck counterparts but return a Future right away; call
+  its result method to wait for the rowids. Don't change data after
+  passing it in, and close the writer when you are done, or queued
+  writes may be lost. Other keyword arguments go to the writer's
+  DumpTruck.
+  '''
+
+  def __init__(self, dbname = 'dumptruck.db', batch_size = 1000, max_pending = 10000, **kwargs):
+    if type(batch_size) not in [int, long] or batch_size < 1:
+      raise ValueError('batch_size must be a positive integer')
+    self.batch_size = batch_size
+
+    self.__queue = Queue.Queue(max_pending)
+    self.__closed = False
+    self.__lock = threading.Lock()
+
+    # The DumpTruck must be made in the thread that uses it.
+    started = Future()
+    self.__thread = threading.Thread(target = self.__run, args = (dbname, kwargs, started))
+    self.__thread.daemon = True
+    self.__thread.start()
+    started.result()
+
+  def __run(self, dbname, kwargs, started):
+    try:
+      dt = DumpTruck(dbname, **kwargs)
+    except Exception, e:
+      started.set_exception(e)
+      return
+    else:
+      started.set_result(None)
+
+    stopping = False
+    while not stopping:
+      batch = [self.__queue.get()]
+      while len(batch) < self.batch_size:
+        try:
+          batch.append(self.__queue.get_nowait())
+        except Queue.Empty:
+          break
+
+      stopping = STOP in batch
+      self.__write(dt, [write for write in batch if write is not STOP])
+      for write in batch:
+        self.__queue.task_done()
+
+    dt.close()
+
+  def __write(self, dt, writes):
+    'Do a batch of writes in one transaction, each in its own savepoint.'
+    results = []
+    try:
+      with dt.transaction():
+        for future, method, args, kwargs in writes:
+          try:
+            with dt.savepoint():
+              result = getattr(dt, method)(*args, **kwargs)
+          except Exception, e:
+            results.append((future, None, e))
+          else:
+            results.append((future, result, None))
+    except Exception, e:
+      # The commit failed, so nothing was written.
+      for future, method, args, kwargs in writes:
+        future.set_exception(e)
+      return
+
+    for future, result, exception in results:
+      if exception == None:
+        future.set_result(result)
+      else:
+        future.set_exception(exception)
+
+  def __put(self, method, *args, **kwargs):
+    future = Future()
+    with self.__lock:
+      if self.__closed:
+        raise ValueError('The writer is closed.')
+      self.__queue.put((future, method, args, kwargs))
+    return future
+
+  def insert(self, *args, **kwargs):
+    return self.__put('insert', *args, **kwargs)
+
+  def upsert(self, *args, **kwargs):
+    return self.__put('upsert', *args, **kwargs)
+
+  def save_var(self, *args, **kwargs):
+    return self.__put('save_var', *args, **kwargs)
+
+  def save_vars(self, *args, **kwargs):
+    return self.__put('save_vars', *args, **kwargs)
+
+  def flush(self):
+    'Wait until everything queued so far has been committed.'
+    self.__queue.join()
+
+  def close(self):
+    'Write everything that is queued, then stop the writer thread.'
+    with self.__lock:
+      if self.__closed:
+        return
+      self.__closed = True
+      self.__queue.put(STOP)
+    self.__thread.join()
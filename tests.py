@@ -23,13 +23,21 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 
 from collections import OrderedDict
-from unittest import TestCase, main
+from unittest import TestCase, main, skipIf
 from json import dumps
-from dumptruck import DumpTruck, Pickle, quote
+from dumptruck import DumpTruck, DumpTruckPool, DumpTruckWriter, AsyncDumpTruck, Pickle, Lazy, quote, sharded_insert
+from dumptruck.adapters_and_converters import convert_date, convert_datetime
 import sqlite3
 import os, shutil
 import datetime
+import threading
 import lxml.etree, lxml.html
+from array import array
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 DB_FILE = '/tmp/test.db'
 
@@ -60,6 +68,51 @@ class TestQuote(TestCase):
     self.assertQuote('ao 98!?o-_H`oe&((*^ueu','[ao 98!?o-_H`oe&((*^ueu]')
     self.assertQuote('no^[hs!\'e]?\'sf_"&\'', '`no^[hs!\'e]?\'sf_"&\'`')
 
+class TestQuoteCache(TestCase):
+  def test_cache_info(self):
+    quote.cache_clear()
+    quote(u'spam')
+    quote(u'spam')
+    quote(u'eggs')
+    info = quote.cache_info()
+    self.assertEqual((info.hits, info.misses, info.currsize), (1, 2, 2))
+
+  def test_bounded(self):
+    from dumptruck.convert import memoize
+    calls = []
+    @memoize(2)
+    def double(text):
+      calls.append(text)
+      return text * 2
+    for text in ['a', 'b', 'a', 'c', 'a']:
+      self.assertEqual(double(text), text * 2)
+    # The cache was full, so it was emptied to make room for 'c'.
+    self.assertListEqual(calls, ['a', 'b', 'c', 'a'])
+    self.assertEqual(double.cache_info().currsize, 2)
+
+  def test_threads(self):
+    from dumptruck.convert import memoize
+    double = memoize(100)(lambda text: text * 2)
+    errors = []
+    def run():
+      try:
+        for i in range(3000):
+          double(u'col%d' % i)
+      except Exception, e:
+        errors.append(e)
+    threads = [threading.Thread(target = run) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertListEqual(errors, [])
+    self.assertLessEqual(double.cache_info().currsize, 100)
+
+  def test_errors_not_cached(self):
+    quote.cache_clear()
+    self.assertRaises(ValueError, quote, ']`')
+    self.assertEqual(quote.cache_info().currsize, 0)
+
 class TestQuoteError(TestCase):
   'Unquotables should raise a particular ValueError.'
   def assertQuoteError(self, textIn):
@@ -68,6 +121,22 @@ class TestQuoteError(TestCase):
   def test_quote_error(self):
     self.assertQuoteError(']`')
 
+class TestConvert(TestCase):
+  def test_convert(self):
+    from dumptruck.convert import convert
+    data = [{u'a': 1, u'b': None}, {u'a': 2, u'b': None}]
+    self.assertListEqual(convert(data), [[(u'`a`', 1)], [(u'`a`', 2)]])
+
+  def test_input_unchanged(self):
+    from dumptruck.convert import convert
+    row = {u'a': 1, u'b': None}
+    convert(row)
+    self.assertDictEqual(row, {u'a': 1, u'b': None})
+
+  def test_generator(self):
+    from dumptruck.convert import convert
+    self.assertListEqual(convert({u'a': i} for i in range(2)), [[(u'`a`', 0)], [(u'`a`', 1)]])
+
 class TestDb(TestCase):
   def setUp(self):
     self.cleanUp()
@@ -78,7 +147,7 @@ class TestDb(TestCase):
 
   def cleanUp(self):
     'Clean up temporary files.'
-    for filename in ('/tmp/test.db', 'dumptruck.db'):
+    for filename in ('/tmp/test.db', '/tmp/test.db-wal', '/tmp/test.db-shm', 'dumptruck.db'):
       try:
         os.remove(filename)
       except OSError as e:
@@ -111,6 +180,26 @@ class TestAdaptersAndConverters(TestDb):
     dt.insert({'bar': elementstringresult}, 'foo')
     self.assertEqual(type(dt.dump('foo')[0]['bar']), unicode)
 
+class TestDateConverters(TestCase):
+  def test_date(self):
+    self.assertEqual(convert_date('2012-10-08'), datetime.date(2012, 10, 8))
+    self.assertEqual(convert_date('2012-1-8'), datetime.date(2012, 1, 8))
+
+  def test_datetime(self):
+    self.assertEqual(convert_datetime('2012-10-08 13:05:09'), datetime.datetime(2012, 10, 8, 13, 5, 9))
+    self.assertEqual(convert_datetime('2012-10-08 13:05:09.000250'), datetime.datetime(2012, 10, 8, 13, 5, 9, 250))
+    self.assertEqual(convert_datetime('2012-10-8 1:05:09'), datetime.datetime(2012, 10, 8, 1, 5, 9))
+
+  def test_invalid(self):
+    self.assertRaises(ValueError, lambda: convert_date('October 8, 2012'))
+    self.assertRaises(ValueError, lambda: convert_datetime('2012-10-08'))
+
+  def test_cache(self):
+    convert_date.cache_clear()
+    for i in range(3):
+      convert_date('2012-10-08')
+    self.assertEqual(convert_date.cache_info().hits, 2)
+
 class TestNoAdaptersAndConverters(TestDb):
   def test_no_adapt_list(self):
     dt = DumpTruck(dbname = '/tmp/test.db', adapt_and_convert = False)
@@ -165,6 +254,186 @@ class TestDump(TestDb):
     self.assertEqual(data, h.dump('foo'))
     h.close()
 
+class TestIterDump(TestDb):
+  def test_iterdump(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    data = [{u'foo': i} for i in range(25)]
+    dt.insert(data)
+    observed = dt.iterdump(chunk_size = 10)
+    self.assertNotIsInstance(observed, list)
+    self.assertListEqual(list(observed), data)
+
+  def test_iterexecute_params(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert([{u'foo': i} for i in range(5)])
+    observed = dt.iterexecute(u'SELECT foo FROM dumptruck WHERE foo > ?', [2])
+    self.assertListEqual([row['foo'] for row in observed], [3, 4])
+
+  def test_interleaved(self):
+    "Other queries don't disturb the rows being iterated."
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert([{u'foo': i} for i in range(5)])
+    observed = []
+    for row in dt.iterdump(chunk_size = 2):
+      observed.append(row['foo'])
+      dt.execute(u'SELECT count(*) FROM dumptruck')
+    self.assertListEqual(observed, range(5))
+
+  def test_not_a_query(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    self.assertIsNone(dt.iterexecute(u'CREATE TABLE foo (bar integer)'))
+
+class TestRowFactory(TestDb):
+  def setUp(self):
+    self.cleanUp()
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert([OrderedDict([(u'foo', 1), (u'bar', u'a')]), OrderedDict([(u'foo', 2), (u'bar', u'b')])])
+    dt.close()
+
+  def test_default(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    self.assertEqual(type(dt.dump()[0]), OrderedDict)
+
+  def test_tuple(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', row_factory = 'tuple')
+    self.assertListEqual(dt.dump(), [(1, u'a'), (2, u'b')])
+    self.assertSetEqual(dt.tables(), {u'dumptruck'})
+
+  def test_row(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', row_factory = 'row')
+    row = dt.dump()[1]
+    self.assertIsInstance(row, sqlite3.Row)
+    self.assertEqual(row['bar'], u'b')
+
+  def test_record(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', row_factory = 'record')
+    rows = dt.dump()
+    self.assertEqual(rows[0], (1, u'a'))
+    self.assertEqual(rows[1]['bar'], u'b')
+    self.assertEqual(rows[1].keys(), [u'foo', u'bar'])
+    self.assertIs(type(rows[0]), type(rows[1]))
+    self.assertIs(type(rows[0]), type(dt.dump()[0]))
+
+  def test_record_streaming(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    rows = list(dt.iterdump(row_factory = 'record'))
+    self.assertEqual(rows[0].items(), [(u'foo', 1), (u'bar', u'a')])
+
+  def test_per_call(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', row_factory = 'tuple')
+    self.assertEqual(dt.execute('SELECT foo FROM dumptruck', row_factory = 'ordereddict')[0], {u'foo': 1})
+
+  def test_invalid(self):
+    self.assertRaises(ValueError, DumpTruck, dbname = '/tmp/test.db', row_factory = 'list')
+
+class TestColumns(TestDb):
+  def setUp(self):
+    self.cleanUp()
+    self.dt = DumpTruck(dbname = '/tmp/test.db')
+    self.dt.insert([
+      {u'i': 1, u'r': 1.5, u'b': True, u'd': datetime.date(2012, 10, 8), u's': u'a'},
+      {u'i': None, u'r': 2.5, u'b': False, u's': None},
+      {u'i': 3},
+    ], u'numbers')
+
+  def test_arrays(self):
+    columns = self.dt.dump_columns(u'numbers', numpy = False)
+    self.assertEqual(columns[u'i'], array('l', [1, 0, 3]))
+    self.assertEqual(columns.masks[u'i'], array('B', [0, 1, 0]))
+    self.assertEqual(columns[u'r'], array('d', [1.5, 2.5, 0]))
+    self.assertEqual(columns[u'b'], array('b', [1, 0, 0]))
+    self.assertEqual(columns[u'd'], [datetime.date(2012, 10, 8), None, None])
+    self.assertEqual(columns[u's'], [u'a', None, None])
+
+  def test_guess(self):
+    columns = self.dt.execute_columns(u'SELECT i * 2 AS i2, s FROM numbers', numpy = False, chunk_size = 1)
+    self.assertListEqual(columns.keys(), [u'i2', u's'])
+    self.assertEqual(columns[u'i2'], array('l', [2, 0, 6]))
+
+  def test_mixed(self):
+    sql = u'SELECT CASE WHEN i = 3 THEN \'x\' ELSE i END AS m FROM numbers'
+    columns = self.dt.execute_columns(sql, numpy = False, chunk_size = 1)
+    self.assertEqual(columns[u'm'], [1, None, u'x'])
+
+  def test_empty(self):
+    columns = self.dt.execute_columns(u'SELECT i FROM numbers WHERE 0', types = {u'i': u'integer'}, numpy = False)
+    self.assertEqual(columns[u'i'], array('l'))
+
+  @skipIf(numpy == None, 'NumPy is not installed')
+  def test_numpy(self):
+    columns = self.dt.dump_columns(u'numbers', numpy = True)
+    self.assertEqual(columns[u'i'].dtype, numpy.dtype('l'))
+    self.assertListEqual(columns[u'i'].mask.tolist(), [False, True, False])
+    self.assertEqual(columns[u'b'].dtype, numpy.dtype(bool))
+    self.assertEqual(columns[u'd'].dtype, numpy.dtype('datetime64[D]'))
+    self.assertEqual(columns[u's'][0], u'a')
+
+class TestInsertColumns(TestDb):
+  def test_insert(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    columns = OrderedDict([(u'i', array('l', [1, 2])), (u's', [None, u'b']), (u'n', [None, None])])
+    self.assertEqual(dt.insert_columns(columns, u'letters'), 2)
+    types = [column[1:3] for column in dt.execute(u'PRAGMA table_info(letters)', row_factory = u'tuple')]
+    self.assertListEqual(types, [(u'i', u'INTEGER'), (u's', u'TEXT')])
+    self.assertListEqual(dt.dump(u'letters', row_factory = u'tuple'), [(1, None), (2, u'b')])
+
+  def test_new_column(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert({u'i': 1}, u'letters')
+    dt.insert_columns({u'i': [2], u'd': [datetime.date(2012, 10, 8)]}, u'letters')
+    self.assertListEqual(dt.dump(u'letters', row_factory = u'tuple'), [(1, None), (2, datetime.date(2012, 10, 8))])
+
+  def test_round_trip(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert([{u'i': 1, u'r': 0.5}, {u'r': 1.5}], u'numbers')
+    dt.insert_columns(dt.dump_columns(u'numbers', numpy = False), u'copy')
+    self.assertListEqual(dt.dump(u'copy'), dt.dump(u'numbers'))
+
+  def test_lengths(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    self.assertRaises(ValueError, dt.insert_columns, {u'a': [1, 2], u'b': [1]})
+    self.assertRaises(ValueError, dt.insert_columns, {u'a': [None]})
+
+class TestLazy(TestDb):
+  def setUp(self):
+    self.cleanUp()
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert({u'foo': [1, 2], u'bar': {u'baz': 3}, u'n': 4})
+    dt.close()
+
+  def test_default(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    self.assertEqual(type(dt.dump()[0][u'foo']), list)
+
+  def test_lazy(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', lazy = True)
+    row = dt.dump()[0]
+    self.assertIsInstance(row[u'foo'], Lazy)
+    self.assertEqual(row[u'foo'].raw, '[1, 2]')
+    self.assertEqual(row[u'foo'], [1, 2])
+    self.assertEqual(row[u'bar'][u'baz'], 3)
+    self.assertEqual(row[u'bar'].keys(), [u'baz'])
+    self.assertEqual(row[u'n'], 4)
+
+  def test_streaming(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    rows = list(dt.iterdump(lazy = True, chunk_size = 1))
+    self.assertIsInstance(rows[0][u'foo'], Lazy)
+    self.assertEqual(type(dt.dump()[0][u'foo']), list)
+
+  def test_save_again(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', lazy = True)
+    row = dt.dump()[0]
+    dt.insert(row, u'copy')
+    row[u'foo'].append(5)
+    dt.insert(row, u'copy')
+    observed = [row[u'foo'] for row in dt.dump(u'copy', lazy = False)]
+    self.assertListEqual(observed, [[1, 2], [1, 2, 5]])
+    self.assertEqual(dt.execute(u'SELECT typeof(foo) FROM copy', row_factory = u'tuple')[0], (u'text',))
+
+  def test_invalid(self):
+    self.assertRaises(TypeError, DumpTruck, dbname = '/tmp/test.db', lazy = 'yes')
+
 class TestDrop(TestDb):
   def test_drop_nonexistant(self):
     h = DumpTruck(dbname = '/tmp/test.db')
@@ -341,6 +610,106 @@ class TestVarsSQL(DumpTruckVars):
 #    y = lambda x: x^2
 #    self.save_check_get('foo', y, 'blob')
 
+class TestVarsTypes(DumpTruckVars):
+  def test_date(self):
+    self.save(u'foo', datetime.date(2012, 10, 8))
+    self.check(u'foo', u'2012-10-08', u'date')
+    self.get(u'foo', datetime.date(2012, 10, 8))
+
+  def test_list(self):
+    self.save(u'foo', [1, u'two'])
+    self.check(u'foo', u'[1, "two"]', u'json text')
+    self.get(u'foo', [1, u'two'])
+
+  def test_no_temporary_tables(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_var(u'foo', {u'bar': 3})
+    dt.get_var(u'foo')
+    self.assertSetEqual(dt.tables(), {u'_dumptruckvars'})
+
+class TestVarsCache(TestDb):
+  def test_read_through(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_var(u'page', 3)
+    self.assertEqual(dt.get_var(u'page'), 3)
+
+    # Later reads come from memory.
+    reads = []
+    def authorizer(action, *args):
+      if action == sqlite3.SQLITE_READ and args[0] == u'_dumptruckvars':
+        reads.append(args)
+      return sqlite3.SQLITE_OK
+    dt.connection.set_authorizer(authorizer)
+    self.assertEqual(dt.get_var(u'page'), 3)
+    self.assertListEqual(reads, [])
+
+  def test_other_connection(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_var(u'page', 3)
+    self.assertEqual(dt.get_var(u'page'), 3)
+    connection = sqlite3.connect(u'/tmp/test.db')
+    connection.execute(u'UPDATE _dumptruckvars SET value = 4')
+    connection.commit()
+    connection.close()
+    self.assertEqual(dt.get_var(u'page'), 4)
+
+  def test_execute(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_var(u'page', 3)
+    self.assertEqual(dt.get_var(u'page'), 3)
+    dt.execute(u'DELETE FROM _dumptruckvars')
+    self.assertRaises(NameError, dt.get_var, u'page')
+
+  def test_iterexecute(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_var(u'page', 3)
+    self.assertEqual(dt.get_var(u'page'), 3)
+    dt.iterexecute(u'UPDATE _dumptruckvars SET value = 2')
+    dt.commit()
+    self.assertEqual(dt.get_var(u'page'), 2)
+
+  def test_save_updates(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_var(u'page', 3)
+    dt.get_var(u'page')
+    dt.save_var(u'page', [4])
+    self.assertEqual(dt.get_var(u'page'), [4])
+
+  def test_fresh_copies(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_var(u'pages', [1])
+    dt.get_var(u'pages').append(2)
+    self.assertEqual(dt.get_var(u'pages'), [1])
+
+class TestBulkVars(TestDb):
+  def test_save_get(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    variables = {u'page': 3, u'seen': [u'a', u'b'], u'day': datetime.date(2012, 10, 8)}
+    dt.save_vars(variables)
+    dt.close()
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    self.assertDictEqual(dt.get_vars([u'page', u'seen', u'day']), variables)
+
+  def test_many(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    variables = {u'var%d' % i: i for i in range(1200)}
+    dt.save_vars(variables)
+    dt.close()
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    self.assertDictEqual(dt.get_vars(variables.keys()), variables)
+
+  def test_missing(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_vars({u'page': 3})
+    self.assertRaises(NameError, dt.get_vars, [u'page', u'line'])
+
+  def test_table_dropped(self):
+    dt = DumpTruck(dbname = u'/tmp/test.db')
+    dt.save_var(u'page', 3)
+    dt.drop(u'_dumptruckvars')
+    dt.save_var(u'page', 4)
+    self.assertEqual(dt.get_var(u'page'), 4)
+
 class TestSelect(TestDb):
   def test_select(self):
     shutil.copy(u'fixtures/landbank_branches.sqlite', u'.')
@@ -684,6 +1053,238 @@ class TestDumpTruckParams(TestDb):
 #   self.assertEqual(h.auto_commit, False)
 #   self.assertEqual(h.__vars_table, 'baz')
 
+class TestPragmas(TestDb):
+  def test_default(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    self.assertEqual(dt.pragmas()['journal_mode'], u'delete')
+
+  def test_profile(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', profile = 'bulk_load')
+    pragmas = dt.pragmas()
+    self.assertEqual(pragmas['journal_mode'], u'wal')
+    self.assertEqual(pragmas['synchronous'], 0)
+    self.assertEqual(pragmas['cache_size'], -262144)
+    self.assertEqual(pragmas['temp_store'], 2)
+
+  def test_overrides(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', profile = 'read_mostly', pragmas = {'synchronous': 'FULL', 'page_size': 8192, 'foreign_keys': 'ON'})
+    pragmas = dt.pragmas()
+    self.assertEqual(pragmas['journal_mode'], u'wal')
+    self.assertEqual(pragmas['synchronous'], 2)
+    self.assertEqual(pragmas['page_size'], 8192)
+    self.assertEqual(pragmas['foreign_keys'], 1)
+    self.assertEqual(pragmas['mmap_size'], 268435456)
+
+  def test_no_commit(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', auto_commit = False)
+    dt.insert({u'foo': 1}, u'bar')
+    dt.commit()
+    dt.insert({u'foo': 2}, u'bar')
+    dt.pragmas()
+    dt.connection.rollback()
+    self.assertEqual(dt.execute(u'SELECT foo FROM bar'), [{u'foo': 1}])
+
+  def test_invalid(self):
+    self.assertRaises(ValueError, DumpTruck, dbname = '/tmp/test.db', profile = 'fast')
+    self.assertRaises(TypeError, DumpTruck, dbname = '/tmp/test.db', pragmas = ['synchronous'])
+    self.assertRaises(ValueError, DumpTruck, dbname = '/tmp/test.db', pragmas = {'synchronous': 'OFF; DROP TABLE foo'})
+
+class TestPool(TestDb):
+  def run_threads(self, target, n = 4):
+    errors = []
+    def run(i):
+      try:
+        target(i)
+      except Exception as e:
+        errors.append(e)
+    threads = [threading.Thread(target = run, args = (i,)) for i in range(n)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertListEqual(errors, [])
+
+  def test_threads(self):
+    pool = DumpTruckPool('/tmp/test.db', profile = 'bulk_load', timeout = 30)
+    def insert(i):
+      for j in range(20):
+        pool.insert({u'thread': i, u'column%d' % i: j})
+    self.run_threads(insert)
+    self.assertEqual(pool.execute(u'SELECT count(*) AS c FROM dumptruck')[0]['c'], 80)
+
+  def test_own_connection(self):
+    pool = DumpTruckPool('/tmp/test.db')
+    connections = [pool.get().connection]
+    def get(i):
+      connections.append(pool.get().connection)
+      self.assertIs(pool.get().connection, connections[-1])
+    self.run_threads(get, 2)
+    self.assertEqual(len(set(map(id, connections))), 3)
+
+  def test_shared_schema_cache(self):
+    pool = DumpTruckPool('/tmp/test.db')
+    pool.insert({u'foo': 1})
+    def add_column(i):
+      pool.insert({u'foo': 2, u'bar': 3})
+    self.run_threads(add_column, 1)
+    pool.insert({u'bar': 4})
+    self.assertListEqual([row['bar'] for row in pool.dump()], [None, 3, 4])
+
+  def test_memory(self):
+    self.assertRaises(ValueError, DumpTruckPool, ':memory:')
+
+class TestWriter(TestDb):
+  def test_producers(self):
+    writer = DumpTruckWriter('/tmp/test.db', batch_size = 50, max_pending = 10)
+    futures = []
+    def produce(i):
+      for j in range(25):
+        futures.append(writer.insert({u'thread': i, u'j': j}))
+    threads = [threading.Thread(target = produce, args = (i,)) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    writer.close()
+
+    self.assertListEqual(sorted(future.result() for future in futures), range(1, 101))
+    dt = DumpTruck('/tmp/test.db')
+    self.assertEqual(dt.execute(u'SELECT count(*) AS c FROM dumptruck')[0]['c'], 100)
+
+  def test_flush(self):
+    writer = DumpTruckWriter('/tmp/test.db')
+    writer.insert([{u'foo': 1}, {u'foo': 2}])
+    writer.save_var(u'page', 2)
+    writer.flush()
+    dt = DumpTruck('/tmp/test.db')
+    self.assertEqual(len(dt.dump()), 2)
+    self.assertEqual(dt.get_var(u'page'), 2)
+    writer.close()
+
+  def test_failure_is_isolated(self):
+    writer = DumpTruckWriter('/tmp/test.db')
+    good = writer.insert({u'foo': 1})
+    bad = writer.insert({u'foo': {1: 2}})
+    also_good = writer.insert({u'foo': 3})
+    writer.close()
+    self.assertEqual(good.result(), 1)
+    self.assertIsInstance(bad.exception(), ValueError)
+    self.assertRaises(ValueError, bad.result)
+    self.assertEqual(also_good.result(), 2)
+
+  def test_closed(self):
+    writer = DumpTruckWriter('/tmp/test.db')
+    writer.close()
+    self.assertRaises(ValueError, writer.insert, {u'foo': 1})
+
+  def test_bad_parameters(self):
+    self.assertRaises(TypeError, DumpTruckWriter, dbname = 3)
+
+class TestAsync(TestDb):
+  def test_methods(self):
+    adt = AsyncDumpTruck('/tmp/test.db')
+    rowids = adt.insert([{u'foo': 1}, {u'foo': 2, u'bar': u'baz'}])
+    rows = adt.execute(u'SELECT foo FROM dumptruck WHERE bar = ?', [u'baz'])
+    self.assertEqual(rowids.result(), [1, 2])
+    self.assertListEqual(rows.result(), [{u'foo': 2}])
+    adt.close()
+
+  def test_errors(self):
+    adt = AsyncDumpTruck('/tmp/test.db')
+    self.assertRaises(sqlite3.OperationalError, adt.dump(u'nonexistent').result)
+    adt.close()
+
+  def test_callback(self):
+    adt = AsyncDumpTruck('/tmp/test.db')
+    done = threading.Event()
+    results = []
+    def callback(future):
+      results.append(future.result())
+      done.set()
+    adt.save_var(u'page', 3)
+    adt.get_var(u'page').add_done_callback(callback)
+    done.wait(5)
+    self.assertListEqual(results, [3])
+    adt.close()
+
+  def test_stream(self):
+    adt = AsyncDumpTruck('/tmp/test.db')
+    adt.insert([{u'foo': i} for i in range(5)])
+    stream = adt.iterdump(chunk_size = 2).result()
+    chunks = []
+    while True:
+      chunk = stream.next_chunk().result()
+      if chunk == []:
+        break
+      chunks.append([row['foo'] for row in chunk])
+    self.assertListEqual(chunks, [[0, 1], [2, 3], [4]])
+    adt.close()
+
+  def test_closed(self):
+    adt = AsyncDumpTruck('/tmp/test.db')
+    adt.close()
+    self.assertRaises(ValueError, adt.insert, {u'foo': 1})
+
+class TestShardedInsert(TestDb):
+  def test_sharded(self):
+    dt = DumpTruck('/tmp/test.db')
+    data = [{u'i': i} for i in range(100)]
+    data[10][u'when'] = datetime.date(2012, 10, 8)
+    data[90][u'tags'] = [u'a', u'b']
+    data[95][u'TAGS2'] = 3
+    data[50] = {}
+    self.assertEqual(sharded_insert(dt, data, u'numbers', processes = 3), 100)
+
+    rows = dt.dump(u'numbers')
+    self.assertListEqual([row['i'] for row in rows], range(50) + [None] + range(51, 100))
+    self.assertEqual(rows[10]['when'], datetime.date(2012, 10, 8))
+    self.assertEqual(rows[90]['tags'], [u'a', u'b'])
+    self.assertEqual(rows[95]['TAGS2'], 3)
+
+  def test_existing_table(self):
+    dt = DumpTruck('/tmp/test.db')
+    dt.insert({u'foo': u'bar'})
+    sharded_insert(dt, [{u'i': i} for i in range(10)], processes = 2)
+    self.assertEqual(len(dt.dump()), 11)
+    dt.insert({u'i': 10, u'foo': u'baz'})
+    self.assertEqual(len(dt.dump()), 12)
+
+  def test_types_from_all_rows(self):
+    dt = DumpTruck('/tmp/test.db')
+    dt.insert({u'i': 0})
+    data = [{u'foo': 1}, {u'foo': 2}, {u'foo': 2.5}, {u'bar': 3}, {u'bar': 4.5}]
+    sharded_insert(dt, data, processes = 2)
+    types = {row['name']: row['type'].lower() for row in dt.execute('PRAGMA table_info(dumptruck)')}
+    self.assertDictEqual(types, {u'i': u'integer', u'foo': u'real', u'bar': u'real'})
+
+    sharded_insert(dt, data, u'new', processes = 2)
+    types = {row['name']: row['type'].lower() for row in dt.execute('PRAGMA table_info(new)')}
+    self.assertDictEqual(types, {u'foo': u'real', u'bar': u'real'})
+
+  def test_first_row_null(self):
+    dt = DumpTruck('/tmp/test.db')
+    self.assertEqual(sharded_insert(dt, [{}, {u'foo': 1}], processes = 2), 2)
+    self.assertListEqual(dt.dump(), [{u'foo': None}, {u'foo': 1}])
+    self.assertRaises(ValueError, sharded_insert, dt, [{}, {}], u'nulls', processes = 2)
+
+  def test_atomic(self):
+    # A conflict in the last slice leaves none of the rows in the table.
+    dt = DumpTruck('/tmp/test.db')
+    dt.insert({u'i': 9})
+    dt.create_index([u'i'], u'dumptruck', unique = True)
+    self.assertRaises(sqlite3.IntegrityError, sharded_insert, dt, [{u'i': i} for i in range(10)], processes = 3)
+    self.assertListEqual(dt.dump(), [{u'i': 9}])
+
+  def test_many_shards(self):
+    # More shards than SQLite can attach at once get combined first.
+    dt = DumpTruck('/tmp/test.db')
+    data = [{u'i': i} for i in range(24)]
+    data[23][u'late'] = u'column'
+    self.assertEqual(sharded_insert(dt, data, processes = 12), 24)
+    rows = dt.dump()
+    self.assertListEqual([row['i'] for row in rows], range(24))
+    self.assertEqual(rows[23]['late'], u'column')
+
 class TestParamsDefaults(TestDb):
   def test_params(self):
     self.assertFalse(os.path.isfile('dumptruck.db'))
@@ -742,6 +1343,13 @@ class TestNull(SaveAndCheck):
       dt.insert({}, 'two')
     dt.close()
 
+  def test_empty_row_before_others(self):
+    "An empty first row is fine if a later row defines the schema."
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert([{}, {'z': 1}], 't')
+    self.assertListEqual(dt.dump('t'), [{u'z': None}, {u'z': 1}])
+    dt.close()
+
   def test_empty_row_second_insert(self):
     "An empty row acts like any other row."
     dt = DumpTruck(dbname = '/tmp/test.db')
@@ -774,6 +1382,264 @@ class TestNull(SaveAndCheck):
     dt.close()
     self.assertEqual(c, 0)
 
+class TestSchemaCache(TestDb):
+  def count_alters(self, dt):
+    alters = []
+    def authorizer(action, *args):
+      if action == sqlite3.SQLITE_ALTER_TABLE:
+        alters.append(args)
+      return sqlite3.SQLITE_OK
+    dt.connection.set_authorizer(authorizer)
+    return alters
+
+  def test_only_new_columns(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert({u'foo': 1, u'bar': 2})
+    alters = self.count_alters(dt)
+    dt.insert([{u'foo': 3, u'bar': 4}, {u'Foo': 5, u'baz': 6}, {u'baz': 7, u'bat': 8}])
+    self.assertEqual(len(alters), 2)
+    self.assertSetEqual(set(dt.column_names('dumptruck')), {u'foo', u'bar', u'baz', u'bat'})
+
+  def test_new_table_without_alters(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    alters = self.count_alters(dt)
+    dt.insert([{u'foo': 1}, {u'bar': u'two'}, {u'baz': 3.0, u'foo': 4}])
+    self.assertListEqual(alters, [])
+    self.assertListEqual(list(dt.column_names('dumptruck')), [u'foo', u'bar', u'baz'])
+
+  def test_types_from_all_values(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert([{u'foo': True, u'bar': 1, u'baz': u'a'}, {u'foo': 2, u'bar': 2.5, u'baz': 3}])
+    types = {row['name']: row['type'].lower() for row in dt.execute('PRAGMA table_info(dumptruck)')}
+    self.assertDictEqual(types, {u'foo': u'integer', u'bar': u'real', u'baz': u'text'})
+
+  def test_other_connection(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.save_var(u'x', 1)
+    dt.insert({u'a': 1}, u't')
+    connection = sqlite3.connect('/tmp/test.db')
+    connection.execute(u'DROP TABLE t')
+    connection.execute(u'DROP TABLE _dumptruckvars')
+    connection.commit()
+    connection.close()
+    dt.insert({u'a': 2}, u't')
+    dt.save_var(u'x', 2)
+    self.assertListEqual(dt.dump(u't'), [{u'a': 2}])
+    self.assertEqual(dt.get_var(u'x'), 2)
+
+  def test_old_sqlite(self):
+    'SQLite before 3.16 has no pragma functions, so nothing can be remembered.'
+    class OldCursor(object):
+      def __init__(self, cursor):
+        self.cursor = cursor
+      def execute(self, sql, *args):
+        if u'pragma_' in sql:
+          raise sqlite3.OperationalError(u'no such table: %s' % sql.split()[-1])
+        return self.cursor.execute(sql, *args)
+      def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.cursor = OldCursor(dt.cursor)
+    dt.save_var(u'x', 1)
+    dt.insert({u'a': 1}, u't')
+    connection = sqlite3.connect('/tmp/test.db')
+    connection.execute(u'DROP TABLE t')
+    connection.execute(u'DROP TABLE _dumptruckvars')
+    connection.commit()
+    connection.close()
+    dt.insert({u'a': 2}, u't')
+    dt.save_var(u'x', 2)
+    self.assertListEqual(dt.dump(u't'), [{u'a': 2}])
+    self.assertEqual(dt.get_var(u'x'), 2)
+
+  def test_invalidate_on_ddl(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert({u'foo': 1})
+    dt.execute('DROP TABLE dumptruck')
+    dt.execute('CREATE TABLE dumptruck (bar integer)')
+    dt.insert({u'foo': 2})
+    self.assertListEqual(dt.dump(), [{u'bar': None, u'foo': 2}])
+
+  def test_column_added_elsewhere(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert({u'foo': 1})
+    connection = sqlite3.connect('/tmp/test.db')
+    connection.execute('ALTER TABLE dumptruck ADD COLUMN bar integer')
+    connection.close()
+    dt.insert({u'foo': 2, u'bar': 3})
+    self.assertListEqual([row['bar'] for row in dt.dump()], [None, 3])
+
+class TestTransaction(TestDb):
+  def count_rows(self, table_name = u'dumptruck'):
+    connection = sqlite3.connect('/tmp/test.db')
+    try:
+      return connection.execute(u'SELECT count(*) FROM %s' % table_name).fetchone()[0]
+    except sqlite3.OperationalError:
+      return None
+    finally:
+      connection.close()
+
+  def test_deferred_commit(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    with dt.transaction():
+      dt.insert({u'foo': 1})
+      dt.insert({u'foo': 2, u'bar': 3}, commit = True)
+      dt.save_var(u'page', 4)
+      self.assertIsNone(self.count_rows())
+    self.assertEqual(self.count_rows(), 2)
+    self.assertEqual(dt.get_var(u'page'), 4)
+
+  def test_rollback(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert({u'foo': 1})
+    with self.assertRaises(ZeroDivisionError):
+      with dt.transaction():
+        dt.insert({u'foo': 2, u'bar': 3})
+        dt.insert({u'baz': 4}, u'other')
+        1/0
+    self.assertSetEqual(dt.tables(), {u'dumptruck'})
+    self.assertListEqual(dt.dump(), [{u'foo': 1}])
+
+    # The schema cache forgot the rolled-back column.
+    dt.insert({u'bar': 5})
+    self.assertEqual(self.count_rows(), 2)
+
+  def test_savepoint(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    with dt.transaction():
+      dt.insert({u'foo': 1})
+      try:
+        with dt.savepoint():
+          dt.insert({u'foo': 2})
+          raise ValueError
+      except ValueError:
+        pass
+      with dt.savepoint():
+        dt.insert({u'foo': 3})
+    self.assertListEqual([row['foo'] for row in dt.dump()], [1, 3])
+
+  def test_nested(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    with dt.transaction():
+      with dt.transaction():
+        dt.insert({u'foo': 1})
+      self.assertIsNone(self.count_rows())
+    self.assertEqual(self.count_rows(), 1)
+
+class TestInsertStream(TestDb):
+  def test_generator(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    progress = []
+    def rows():
+      for i in range(25):
+        row = {u'i': i}
+        if i == 12:
+          row[u'late'] = u'column'
+        yield row
+    count = dt.insert_stream(rows(), u'numbers', chunk_size = 10, progress = progress.append)
+    self.assertEqual(count, 25)
+    self.assertListEqual(progress, [10, 20, 25])
+    self.assertListEqual([row['i'] for row in dt.dump(u'numbers')], range(25))
+    self.assertEqual(dt.dump(u'numbers')[12]['late'], u'column')
+
+  def test_commits_each_chunk(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', auto_commit = False)
+    counts = []
+    def count(n):
+      connection = sqlite3.connect('/tmp/test.db')
+      counts.append(connection.execute(u'SELECT count(*) FROM dumptruck').fetchone()[0])
+      connection.close()
+    dt.insert_stream(({u'i': i} for i in range(4)), chunk_size = 2, progress = count)
+    self.assertListEqual(counts, [2, 4])
+
+  def test_lazy(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    produced = []
+    def rows():
+      for i in range(6):
+        produced.append(i)
+        yield {u'i': i}
+    seen = []
+    dt.insert_stream(rows(), chunk_size = 2, progress = lambda n: seen.append(len(produced)))
+    self.assertListEqual(seen, [2, 4, 6])
+
+  def test_bad_chunk_size(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    self.assertRaises(ValueError, dt.insert_stream, [], chunk_size = 0)
+
+class TestImport(TestDb):
+  def cleanUp(self):
+    TestDb.cleanUp(self)
+    for filename in ('/tmp/test.csv', '/tmp/test.jsonl'):
+      try:
+        os.remove(filename)
+      except OSError:
+        pass
+
+  def write(self, filename, text):
+    with open(filename, 'wb') as f:
+      f.write(text)
+
+  def test_csv(self):
+    self.write('/tmp/test.csv', 'id,zip,price,day,name,blank\n1,02139,1.5,2012-10-08,Caf\xc3\xa9,\n2,10001,2,2012-10-09,"a, b",\n')
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    progress = []
+    summary = dt.import_csv('/tmp/test.csv', u'shops', chunk_size = 1, progress = progress.append)
+    self.assertEqual(summary.rows, 2)
+    self.assertListEqual(progress, [1, 2])
+    types = [column[1:3] for column in dt.execute(u'PRAGMA table_info(shops)', row_factory = u'tuple')]
+    self.assertListEqual(types, [(u'id', u'INTEGER'), (u'zip', u'TEXT'), (u'price', u'REAL'), (u'day', u'date'), (u'name', u'TEXT'), (u'blank', u'TEXT')])
+    self.assertListEqual(dt.dump(u'shops', row_factory = u'tuple'), [
+      (1, u'02139', 1.5, datetime.date(2012, 10, 8), u'Caf\xe9', None),
+      (2, u'10001', 2.0, datetime.date(2012, 10, 9), u'a, b', None),
+    ])
+
+  def test_csv_outside_sample(self):
+    # Values unlike the sample are kept as text, and short rows are padded.
+    self.write('/tmp/test.csv', 'n,s\n1,a\n2\nthree,c\n')
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.import_csv('/tmp/test.csv', sample_size = 1)
+    self.assertListEqual(dt.dump(row_factory = u'tuple'), [(1, u'a'), (2, None), (u'three', u'c')])
+
+  def test_csv_blank_lines(self):
+    self.write('/tmp/test.csv', 'a,b\n1,x\n\n2,y\n\n')
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    self.assertEqual(dt.import_csv('/tmp/test.csv').rows, 2)
+    self.assertListEqual(dt.dump(row_factory = u'tuple'), [(1, u'x'), (2, u'y')])
+
+  def test_csv_special_numbers(self):
+    # Words that float takes and integers too big for SQLite stay text.
+    big = '12345678901234567890123'
+    self.write('/tmp/test.csv', 'word,id\nNaN,%s\ninf,1\n' % big)
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.import_csv('/tmp/test.csv')
+    types = [column[2] for column in dt.execute(u'PRAGMA table_info(dumptruck)', row_factory = u'tuple')]
+    self.assertListEqual(types, [u'TEXT', u'TEXT'])
+    self.assertListEqual(dt.dump(row_factory = u'tuple'), [(u'NaN', unicode(big)), (u'inf', u'1')])
+
+  def test_csv_values_that_dont_fit(self):
+    # Values after the sample that their column would mangle are errors.
+    for text in ['n\n1\n12345678901234567890123\n', 'n\n1.5\n007\n', 'day\n2012-10-08\nx\n', 'day\n2012-10-08\n2012-10-08 10:00:00\n']:
+      self.cleanUp()
+      self.write('/tmp/test.csv', text)
+      dt = DumpTruck(dbname = '/tmp/test.db')
+      with self.assertRaises(ValueError) as context:
+        dt.import_csv('/tmp/test.csv', sample_size = 1)
+      self.assertIn(u'Line 3', unicode(context.exception))
+
+  def test_csv_long_row(self):
+    self.write('/tmp/test.csv', 'n\n1,2\n')
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    self.assertRaises(ValueError, dt.import_csv, '/tmp/test.csv')
+
+  def test_jsonl(self):
+    self.write('/tmp/test.jsonl', '{"i": 1, "tags": ["a"]}\n\n{"i": 2, "late": true}\n{"i": 3}\n')
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    summary = dt.import_jsonl('/tmp/test.jsonl', u'things', chunk_size = 2, sample_size = 1)
+    self.assertEqual(summary.rows, 3)
+    self.assertListEqual(dt.dump(u'things', row_factory = u'tuple'), [(1, [u'a'], None), (2, None, True), (3, None, None)])
+
 class TestRowId(TestDb):
   def test_one(self):
     dt = DumpTruck(dbname = '/tmp/test.db')
@@ -785,5 +1651,215 @@ class TestRowId(TestDb):
     rowid = dt.insert([{u'foo': 8}, {u'bar': 5}])
     self.assertEqual(rowid, [1, 2])
 
+  def test_batch(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert({u'foo': 0})
+    rowids = dt.insert([{u'foo': 8}, {u'foo': 9}, {u'bar': 5}, {u'bar': 6}, {u'foo': 1}])
+    self.assertEqual(rowids, [2, 3, 4, 5, 6])
+    observed = [row['foo'] for row in dt.execute('SELECT foo FROM dumptruck ORDER BY rowid')]
+    self.assertListEqual(observed, [0, 8, 9, None, None, 1])
+
+  def test_explicit_rowid(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.execute('CREATE TABLE pears (id INTEGER PRIMARY KEY, foo INTEGER)')
+    rowids = dt.insert([{u'id': 10, u'foo': 8}, {u'id': 4, u'foo': 9}], 'pears')
+    self.assertEqual(rowids, [10, 4])
+
+  def test_upsert(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert([{u'foo': 8}, {u'foo': 9}])
+    dt.create_index(['foo'], 'dumptruck', unique = True)
+    rowids = dt.insert([{u'foo': 8}, {u'foo': 9}], upsert = True)
+    self.assertEqual(rowids, [3, 4])
+
+class TestInsertCache(TestDb):
+  def test_column_order(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    rows = [OrderedDict([(u'foo', 1), (u'bar', 2)]), OrderedDict([(u'bar', 4), (u'foo', 3)])]
+    self.assertEqual(dt.insert(rows), [1, 2])
+    self.assertEqual(dt.insert(rows[1]), 3)
+    info = dt.insert_cache_info()
+    self.assertEqual((info.hits, info.misses), (1, 1))
+    observed = dt.execute(u'SELECT foo, bar FROM dumptruck', row_factory = u'tuple')
+    self.assertListEqual(observed, [(1, 2), (3, 4), (3, 4)])
+
+  def test_modes(self):
+    dt = DumpTruck(dbname = '/tmp/test.db')
+    dt.insert({u'foo': 1})
+    dt.upsert({u'foo': 1})
+    self.assertEqual(dt.insert_cache_info().currsize, 2)
+
+  def test_cached_statements(self):
+    dt = DumpTruck(dbname = '/tmp/test.db', cached_statements = 5)
+    self.assertEqual(dt.insert({u'foo': 1}), 1)
+
+class TestResultCache(TestDb):
+  def setUp(self):
+    self.cleanUp()
+    self.dt = DumpTruck(dbname = '/tmp/test.db', result_cache_rows = 3)
+    self.dt.insert([{u'foo': 1}, {u'foo': 2}], u'one')
+    self.dt.insert({u'bar': 1}, u'two')
+
+  def count(self, table_name):
+    return self.dt.execute(u'SELECT count(*) FROM %s' % table_name, row_factory = u'tuple')[0][0]
+
+  def test_hit(self):
+    self.assertEqual(self.dt.execute(u'SELECT foo FROM one WHERE foo = ?', [2]), [{u'foo': 2}])
+    self.assertEqual(self.dt.execute(u'SELECT foo FROM one WHERE foo = ?', [2]), [{u'foo': 2}])
+    self.assertEqual(self.dt.execute(u'SELECT foo FROM one WHERE foo = ?', [1]), [{u'foo': 1}])
+    info = self.dt.result_cache_info()
+    self.assertEqual((info.hits, info.misses, info.results, info.rows), (1, 2, 2, 2))
+
+  def test_insert(self):
+    self.assertEqual((self.count(u'one'), self.count(u'two')), (2, 1))
+    self.dt.insert({u'foo': 3}, u'one')
+    self.assertEqual((self.count(u'one'), self.count(u'two')), (3, 1))
+    self.assertEqual(self.dt.result_cache_info().hits, 1)
+
+  def test_view(self):
+    self.dt.execute(u'CREATE VIEW foos AS SELECT foo FROM one')
+    self.assertEqual(self.count(u'foos'), 2)
+    self.dt.insert({u'foo': 3}, u'one')
+    self.assertEqual(self.count(u'foos'), 3)
+
+  def test_execute(self):
+    self.assertEqual(self.count(u'two'), 1)
+    self.dt.execute(u'DELETE FROM two')
+    self.assertEqual(self.count(u'two'), 0)
+
+  def test_other_connection(self):
+    self.assertEqual(self.count(u'two'), 1)
+    connection = sqlite3.connect('/tmp/test.db')
+    connection.execute(u'DELETE FROM two')
+    connection.commit()
+    connection.close()
+    self.assertEqual(self.count(u'two'), 0)
+
+  def test_rollback(self):
+    try:
+      with self.dt.transaction():
+        self.dt.insert({u'bar': 2}, u'two')
+        self.assertEqual(self.count(u'two'), 2)
+        raise ValueError
+    except ValueError:
+      pass
+    self.assertEqual(self.count(u'two'), 1)
+
+  def test_evict(self):
+    self.dt.execute(u'SELECT * FROM one')
+    self.dt.execute(u'SELECT * FROM two')
+    self.dt.execute(u'SELECT * FROM one')
+    self.assertEqual(self.dt.result_cache_info().rows, 3)
+    self.dt.execute(u'SELECT 1')
+    self.assertEqual(self.dt.result_cache_info().results, 2)
+    self.dt.execute(u'SELECT * FROM one')
+    self.assertEqual(self.dt.result_cache_info().hits, 2)
+
+  def test_not_deterministic(self):
+    self.dt.insert({u'foo': 3}, u'one')
+    self.assertEqual(self.dt.execute(u'SELECT last_insert_rowid() AS id', row_factory = u'tuple'), [(3,)])
+    self.dt.insert({u'foo': 4}, u'one')
+    self.assertEqual(self.dt.execute(u'SELECT last_insert_rowid() AS id', row_factory = u'tuple'), [(4,)])
+    for sql in [u'SELECT foo, random() FROM one', u"SELECT foo FROM one WHERE datetime('now') > '2000'"]:
+      self.dt.execute(sql)
+      self.dt.execute(sql)
+    self.assertEqual(self.dt.result_cache_info().results, 0)
+
+    # Deterministic functions are fine.
+    self.dt.execute(u'SELECT abs(foo) FROM one WHERE foo = 1')
+    self.dt.execute(u'SELECT abs(foo) FROM one WHERE foo = 1')
+    self.assertEqual(self.dt.result_cache_info().hits, 1)
+
+  def test_mutable(self):
+    # Changing a decoded value mustn't change what later queries return.
+    self.dt.insert({u'j': {u'x': 1}}, u'three')
+    for lazy in (False, True):
+      rows = self.dt.execute(u'SELECT j FROM three', lazy = lazy)
+      rows[0][u'j'][u'x'] = 999
+      rows = self.dt.execute(u'SELECT j FROM three', lazy = lazy)
+      self.assertEqual(rows[0][u'j'], {u'x': 1})
+      rows[0][u'j'][u'x'] = 999
+      self.assertEqual(self.dt.execute(u'SELECT j FROM three', lazy = lazy)[0][u'j'], {u'x': 1})
+    self.assertEqual(self.dt.result_cache_info().hits, 4)
+
+  def test_off(self):
+    self.assertEqual(DumpTruck(dbname = '/tmp/test.db').result_cache_info(), None)
+
+class TestMerge(TestDb):
+  def setUp(self):
+    TestDb.setUp(self)
+    self.dt = DumpTruck(dbname = '/tmp/test.db')
+    self.dt.insert([{u'url': u'a', u'n': 1, u'note': u'first'}, {u'url': u'b', u'n': 2}], 'pages')
+    self.dt.create_index(['url'], 'pages', unique = True)
+
+  def pages(self):
+    return [tuple(row.values()) for row in self.dt.execute('SELECT rowid, url, n, note FROM pages ORDER BY rowid')]
+
+  def test_merge(self):
+    rowids = self.dt.upsert([{u'url': u'b', u'n': 3}, {u'url': u'c', u'n': 4}, {u'url': u'a', u'n': 5}], 'pages', merge = True)
+    self.assertEqual(rowids, [2, 3, 1])
+    # Rows keep their rowids and the columns that weren't passed.
+    self.assertListEqual(self.pages(), [(1, u'a', 5, u'first'), (2, u'b', 3, None), (3, u'c', 4, None)])
+
+  def test_one(self):
+    self.assertEqual(self.dt.upsert({u'url': u'b', u'n': 3}, 'pages', key = [u'url']), 2)
+
+  def test_unchanged(self):
+    changes = self.dt.connection.total_changes
+    self.dt.upsert([{u'url': u'a', u'n': 1}, {u'url': u'b'}], 'pages', merge = True)
+    self.assertEqual(self.dt.connection.total_changes, changes)
+
+  def test_missing_key(self):
+    with self.assertRaises(ValueError):
+      self.dt.upsert({u'n': 3}, 'pages', merge = True)
+
+  def test_no_unique_index(self):
+    self.dt.insert({u'url': u'a'}, 'other')
+    with self.assertRaises(ValueError):
+      self.dt.upsert({u'url': u'a'}, 'other', merge = True)
+
+class TestDetectChanges(TestMerge):
+  rows = [{u'url': u'a', u'n': 1}, {u'url': u'b', u'n': 3}, {u'url': u'c', u'n': 4}]
+
+  def test_columns(self):
+    counts = self.dt.upsert(self.rows, 'pages', detect_changes = 'columns')
+    self.assertDictEqual(counts, {u'inserted': 1, u'updated': 1, u'skipped': 1})
+    self.assertListEqual(self.pages(), [(1, u'a', 1, u'first'), (2, u'b', 3, None), (3, u'c', 4, None)])
+
+  def test_hash(self):
+    # The stored rows have no hash yet, so they count as changed once.
+    counts = self.dt.upsert(self.rows, 'pages', detect_changes = 'hash')
+    self.assertDictEqual(counts, {u'inserted': 1, u'updated': 2, u'skipped': 0})
+
+    changes = self.dt.connection.total_changes
+    counts = self.dt.upsert(list(reversed(self.rows)), 'pages', detect_changes = 'hash')
+    self.assertDictEqual(counts, {u'inserted': 0, u'updated': 0, u'skipped': 3})
+    self.assertEqual(self.dt.connection.total_changes, changes)
+
+  def test_hash_after_other_writes(self):
+    # Writes that don't hash the rows mustn't leave stale hashes behind.
+    self.dt.upsert({u'url': u'a', u'n': 1}, 'pages', detect_changes = 'hash')
+    self.dt.upsert({u'url': u'a', u'n': 5}, 'pages', merge = True)
+    counts = self.dt.upsert({u'url': u'a', u'n': 1}, 'pages', detect_changes = 'hash')
+    self.assertDictEqual(counts, {u'inserted': 0, u'updated': 1, u'skipped': 0})
+    self.assertEqual(self.pages()[0][2], 1)
+
+    self.dt.upsert({u'url': u'b', u'n': 7}, 'pages')
+    counts = self.dt.upsert({u'url': u'b', u'n': 7}, 'pages', detect_changes = 'hash')
+    self.assertDictEqual(counts, {u'inserted': 0, u'updated': 0, u'skipped': 1})
+
+  def test_hash_numbers(self):
+    self.dt.upsert({u'url': u'a', u'n': 1}, 'pages', detect_changes = 'hash')
+    counts = self.dt.upsert({u'url': u'a', u'n': 1L}, 'pages', detect_changes = 'hash')
+    self.assertDictEqual(counts, {u'inserted': 0, u'updated': 0, u'skipped': 1})
+
+  def test_empty(self):
+    counts = self.dt.upsert([], 'pages', detect_changes = 'columns')
+    self.assertDictEqual(counts, {u'inserted': 0, u'updated': 0, u'skipped': 0})
+
+  def test_invalid(self):
+    with self.assertRaises(ValueError):
+      self.dt.upsert(self.rows, 'pages', detect_changes = 'content')
+
 if __name__ == '__main__':
   main()